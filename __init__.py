@@ -54,17 +54,26 @@ Next, we can start getting JSON data for a site like this:
 
 """
 from core import *
+import binarysite
 import loader
+import topology
+import wkb
 
 __all__=[
         'dictToLayers',
         'makeLayerJSON',
         'makeTerrainJSON',
+        'triangulateTerrain',
         'ConfigurationInfo',
         'Layer',
         'Site',
         'DataSource',
+        'ConnectionPool',
+        'SiteCache',
         'makeXlsConfigurationFile',
         'loadFromXlsConfigurationFile',
         'loader',
+        'binarysite',
+        'topology',
+        'wkb',
         ]
@@ -0,0 +1,410 @@
+"""
+A compact binary format for sites, for 3D clients.
+
+getSiteJson returns a site as GeoJSON text, which a client has to parse
+in full just to get its coordinate arrays back out. A site package holds
+the same layers (the site, the other sites, every other layer and the
+terrain mesh) as typed arrays instead, so that a client can use them
+where they are, without parsing anything but a small header.
+
+    >>> data = ds.getSiteBinary(203)
+    >>> package = SitePackage(data)
+    >>> buildings = package.layer('buildings')
+    >>> buildings.array('coordinates') # a numpy array of x, y, z
+    >>> buildings.column('height')
+
+The layout is little endian:
+
+    bytes 0-4     the magic string 'PSTB'
+    bytes 4-8     the format version, uint32
+    bytes 8-12    the length of the header, uint32
+    bytes 12-16   zero
+    header        json, padded with spaces to a multiple of 8 bytes
+    body          the buffers, each starting at a multiple of 8 bytes
+
+The header has the site id, the origin (the centroid of the site, which
+every coordinate is relative to), a table of buffers (offset into the
+body, length in bytes, type and count) and a table of layers. Each layer
+has a name, a type, a color, a count and the indexes of its buffers:
+
+'features' layers have count features, and their geometries in five
+buffers, nested like this:
+
+    geometryTypes   uint8, the WKB type code of each feature (0 for none)
+    featureOffsets  uint32, count + 1 indexes into partOffsets
+    partOffsets     uint32, indexes into ringOffsets. A part is a point,
+                    a line or a polygon
+    ringOffsets     uint32, indexes of vertices. A ring is the vertices of
+                    a point, of a line or of one ring of a polygon
+    coordinates     float64, x, y, z for each vertex (z is 0 for 2D data)
+
+so the vertices of the rings of the parts of feature i are found through
+featureOffsets[i] to featureOffsets[i + 1], and so on down.
+
+'mesh' layers (the terrain) have count vertices, and two buffers:
+
+    coordinates     float64, x, y, z for each vertex
+    faces           uint32, three vertex indexes for each triangle
+
+The attributes of a layer are columns, with one value per feature (or
+per vertex, for a mesh). Each column has a name, a type ('int64',
+'float64', 'bool' or 'string') and a values buffer. String columns are
+utf-8 bytes with an offsets buffer of count + 1 uint32 byte offsets.
+Columns with missing values have a uint8 'valid' buffer as well.
+
+The writer needs nothing but the standard library. The reader exposes
+each buffer as a memoryview, and as a NumPy array if NumPy is installed,
+without copying any data. Without NumPy, columns and other buffers can
+still be read as tuples of python numbers.
+"""
+# Standard Library imports
+import struct
+from decimal import Decimal
+from itertools import chain
+try: #try to import json
+    import json #json is in python 2.6 and later standard libraries
+except: #if json doesn't work, try simplejson
+    import simplejson as json
+
+# Third party imports
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+MAGIC = 'PSTB'
+VERSION = 1
+PREAMBLE_LENGTH = 16
+ALIGNMENT = 8
+
+# the WKB type code of each GeoJSON geometry type
+GEOMETRY_TYPES = {'Point':1, 'LineString':2, 'Polygon':3, 'MultiPoint':4,
+        'MultiLineString':5, 'MultiPolygon':6, 'GeometryCollection':7}
+
+# the struct format character and numpy dtype of each buffer type
+BUFFER_FORMATS = {'uint8':'B', 'uint32':'I', 'int64':'q', 'float64':'d'}
+BUFFER_DTYPES = {'uint8':'<u1', 'uint32':'<u4', 'int64':'<i8', 'float64':'<f8'}
+
+FEATURE_BUFFERS = ('geometryTypes', 'featureOffsets', 'partOffsets',
+        'ringOffsets', 'coordinates')
+FEATURE_BUFFER_TYPES = ('uint8', 'uint32', 'uint32', 'uint32', 'float64')
+
+def _geometryParts(geometry):
+    '''returns the parts of a GeoJSON geometry dictionary, each a list of
+    rings, each a list of positions.'''
+    geometryType = geometry['type']
+    coordinates = geometry.get('coordinates')
+    if geometryType == 'Point':
+        if not coordinates: # an empty point
+            return []
+        return [[[coordinates]]]
+    elif geometryType == 'LineString':
+        return [[coordinates]]
+    elif geometryType == 'Polygon':
+        return [coordinates]
+    elif geometryType == 'MultiPoint':
+        return [[[position]] for position in coordinates]
+    elif geometryType == 'MultiLineString':
+        return [[line] for line in coordinates]
+    elif geometryType == 'MultiPolygon':
+        return coordinates
+    elif geometryType == 'GeometryCollection':
+        return [part for member in geometry['geometries']
+                for part in _geometryParts(member)]
+    raise ValueError('unknown geometry type %s' % geometryType)
+
+def featureArrays(geometries):
+    '''builds the five geometry arrays of a 'features' layer (see the
+    module documentation) from a list of GeoJSON geometries, as json
+    strings or dictionaries. Returns a dictionary of lists.'''
+    geometryTypes = []
+    featureOffsets = [0]
+    partOffsets = [0]
+    ringOffsets = [0]
+    coordinates = []
+    for geometry in geometries:
+        if isinstance(geometry, basestring):
+            geometry = json.loads(geometry)
+        if geometry is None:
+            geometryTypes.append(0)
+        else:
+            geometryTypes.append(GEOMETRY_TYPES[geometry['type']])
+            for rings in _geometryParts(geometry):
+                for ring in rings:
+                    for position in ring:
+                        coordinates.extend(position[:3])
+                        if len(position) < 3:
+                            coordinates.append(0.0)
+                    ringOffsets.append(len(coordinates) // 3)
+                partOffsets.append(len(ringOffsets) - 1)
+        featureOffsets.append(len(partOffsets) - 1)
+    return {'geometryTypes':geometryTypes, 'featureOffsets':featureOffsets,
+            'partOffsets':partOffsets, 'ringOffsets':ringOffsets,
+            'coordinates':coordinates}
+
+def featureLayer(name, arrays, columns, color=None):
+    '''describes a 'features' layer for pack. arrays is a dictionary of
+    the five geometry arrays (see featureArrays), and columns a list of
+    (name, values) tuples with one value per feature.'''
+    return {'name':name, 'type':'features', 'color':color,
+            'count':len(arrays['featureOffsets']) - 1,
+            'arrays':arrays, 'columns':columns}
+
+def meshLayer(name, coordinates, faces, columns, color=None):
+    '''describes a 'mesh' layer for pack. coordinates is a sequence of
+    (x, y, z) vertices and faces a sequence of triangles of vertex
+    indexes, as lists or as NumPy arrays, and columns a list of (name,
+    values) tuples with one value per vertex.'''
+    if not (HAS_NUMPY and isinstance(coordinates, np.ndarray)):
+        coordinates = list(chain.from_iterable(coordinates))
+    if not (HAS_NUMPY and isinstance(faces, np.ndarray)):
+        faces = list(chain.from_iterable(faces))
+    return {'name':name, 'type':'mesh', 'color':color,
+            'count':len(coordinates) // 3 if isinstance(coordinates, list)
+                else len(coordinates),
+            'arrays':{'coordinates':coordinates, 'faces':faces},
+            'columns':columns}
+
+def _packValues(values, bufferType):
+    if HAS_NUMPY and isinstance(values, np.ndarray):
+        return np.ascontiguousarray(values,
+                dtype=BUFFER_DTYPES[bufferType]).tostring()
+    return struct.pack('<%s%s' % (len(values), BUFFER_FORMATS[bufferType]),
+            *values)
+
+def _columnType(values):
+    types = set([type(value) for value in values if value is not None])
+    if not types:
+        return 'string'
+    elif types <= set([bool]):
+        return 'bool'
+    elif types <= set([bool, int, long]):
+        return 'int64'
+    elif types <= set([bool, int, long, float, Decimal]):
+        return 'float64'
+    return 'string'
+
+def _text(value):
+    if value is None:
+        return ''
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, str):
+        return value
+    elif hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return unicode(value).encode('utf-8')
+
+
+class _Body(object):
+    """Collects the buffers of a package, each aligned to ALIGNMENT
+    bytes, and the table that describes them."""
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+        self.buffers = []
+
+    def add(self, data, bufferType, count):
+        '''appends the bytes of a buffer, returning its index.'''
+        padding = -self.length % ALIGNMENT
+        if padding:
+            self.chunks.append('\0' * padding)
+            self.length += padding
+        self.buffers.append({'offset':self.length, 'length':len(data),
+            'type':bufferType, 'count':count})
+        self.chunks.append(data)
+        self.length += len(data)
+        return len(self.buffers) - 1
+
+    def addValues(self, values, bufferType):
+        if HAS_NUMPY and isinstance(values, np.ndarray):
+            count = values.size
+        else:
+            count = len(values)
+        return self.add(_packValues(values, bufferType), bufferType, count)
+
+    def addColumn(self, name, values):
+        '''appends the buffers of an attribute column, returning its
+        description for the header.'''
+        values = list(values)
+        columnType = _columnType(values)
+        column = {'name':name, 'type':columnType}
+        valid = [value is not None for value in values]
+        if not all(valid):
+            column['valid'] = self.addValues(valid, 'uint8')
+        if columnType == 'string':
+            encoded = [_text(value) for value in values]
+            offsets = [0]
+            for text in encoded:
+                offsets.append(offsets[-1] + len(text))
+            column['offsets'] = self.addValues(offsets, 'uint32')
+            column['values'] = self.add(''.join(encoded), 'uint8', offsets[-1])
+        elif columnType == 'float64':
+            column['values'] = self.addValues([float('nan') if value is None
+                else float(value) for value in values], 'float64')
+        elif columnType == 'bool':
+            column['values'] = self.addValues([bool(value) for value in values],
+                    'uint8')
+        else:
+            column['values'] = self.addValues([int(value or 0)
+                for value in values], 'int64')
+        return column
+
+
+def pack(layers, origin=None, site=None):
+    '''packs a list of layers (see featureLayer and meshLayer) into the
+    bytes of a site package. origin is the (x, y) that the coordinates
+    are relative to, and site the id of the site.'''
+    body = _Body()
+    layerTable = []
+    for layer in layers:
+        entry = {'name':layer['name'], 'type':layer['type'],
+                'count':layer['count'], 'buffers':{}}
+        if layer['color'] is not None:
+            entry['color'] = layer['color']
+        if layer['type'] == 'features':
+            bufferTypes = zip(FEATURE_BUFFERS, FEATURE_BUFFER_TYPES)
+        else:
+            bufferTypes = [('coordinates', 'float64'), ('faces', 'uint32')]
+        for name, bufferType in bufferTypes:
+            entry['buffers'][name] = body.addValues(layer['arrays'][name],
+                    bufferType)
+        entry['columns'] = [body.addColumn(name, values)
+                for name, values in layer['columns']]
+        layerTable.append(entry)
+    header = json.dumps({'site':site, 'origin':origin and list(origin),
+        'buffers':body.buffers, 'layers':layerTable})
+    header += ' ' * (-len(header) % ALIGNMENT)
+    return ''.join([MAGIC, struct.pack('<3I', VERSION, len(header), 0),
+        header] + body.chunks)
+
+
+class PackageLayer(object):
+    """One layer of a SitePackage."""
+    def __init__(self, package, entry):
+        self.package = package
+        self.name = entry['name']
+        self.type = entry['type']
+        self.color = entry.get('color')
+        self.count = entry['count']
+        self.buffers = entry['buffers']
+        self.columns = entry['columns']
+
+    def __unicode__(self):
+        return 'PackageLayer: %s (%s %s)' % (self.name, self.count,
+                self.type == 'mesh' and 'vertices' or 'features')
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    @property
+    def columnNames(self):
+        return [column['name'] for column in self.columns]
+
+    def buffer(self, name):
+        '''returns a geometry buffer ('coordinates', 'faces',
+        'ringOffsets', ...) as a memoryview of its bytes.'''
+        return self.package.buffer(self.buffers[name])
+
+    def array(self, name):
+        '''returns a geometry buffer as a read only NumPy array, with
+        coordinates shaped (vertices, 3) and faces shaped (triangles, 3).'''
+        values = self.package.array(self.buffers[name])
+        if name in ('coordinates', 'faces'):
+            return values.reshape((-1, 3))
+        return values
+
+    def _column(self, name):
+        for column in self.columns:
+            if column['name'] == name:
+                return column
+        raise KeyError('%s has no column %s' % (self.name, name))
+
+    def column(self, name):
+        '''returns the values of a column, as a NumPy array for numbers
+        (where missing values are NaN or 0, see valid), or as a list of
+        unicode strings (where missing values are None). Without NumPy,
+        numbers are a tuple of python numbers (or booleans) instead.'''
+        column = self._column(name)
+        if column['type'] != 'string':
+            if not HAS_NUMPY:
+                values = self.package.values(column['values'])
+                if column['type'] == 'bool':
+                    return tuple([bool(value) for value in values])
+                return values
+            values = self.package.array(column['values'])
+            if column['type'] == 'bool':
+                return values.view(np.bool_)
+            return values
+        offsets = self.package.values(column['offsets'])
+        data = self.package.buffer(column['values']).tobytes()
+        valid = self.valid(name)
+        return [data[offsets[i]:offsets[i + 1]].decode('utf-8')
+                if valid is None or valid[i] else None
+                for i in range(len(offsets) - 1)]
+
+    def valid(self, name):
+        '''returns a sequence of booleans that are False where a column
+        is missing a value, or None if no value is missing.'''
+        column = self._column(name)
+        if 'valid' not in column:
+            return None
+        return [bool(flag) for flag in self.package.values(column['valid'])]
+
+
+class SitePackage(object):
+    """Reads the bytes of a site package made by pack (or by
+    DataSource.getSiteBinary). The buffers are not copied: they are
+    views of data, which has to be a str or another object that
+    supports the buffer interface."""
+    def __init__(self, data):
+        if data[:4] != MAGIC:
+            raise ValueError('not a site package')
+        self.version, headerLength, reserved = struct.unpack('<3I', data[4:16])
+        if self.version > VERSION:
+            raise ValueError('site package version %s is newer than %s' % (
+                self.version, VERSION))
+        header = json.loads(data[PREAMBLE_LENGTH:PREAMBLE_LENGTH + headerLength])
+        self.data = data
+        self.bodyOffset = PREAMBLE_LENGTH + headerLength
+        self.site = header['site']
+        self.origin = header['origin']
+        self.bufferTable = header['buffers']
+        self.layers = [PackageLayer(self, entry) for entry in header['layers']]
+
+    def __unicode__(self):
+        return 'SitePackage: site %s, %s layers' % (self.site, len(self.layers))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def layer(self, name):
+        '''returns the first layer called name.'''
+        for layer in self.layers:
+            if layer.name == name:
+                return layer
+        raise KeyError('no layer called %s' % name)
+
+    def buffer(self, index):
+        '''returns the buffer at index in the buffer table as a
+        memoryview of its bytes.'''
+        entry = self.bufferTable[index]
+        start = self.bodyOffset + entry['offset']
+        return memoryview(self.data)[start:start + entry['length']]
+
+    def array(self, index):
+        '''returns the buffer at index in the buffer table as a read only
+        NumPy array.'''
+        if not HAS_NUMPY:
+            raise ImportError('NumPy is needed to read buffers as arrays')
+        entry = self.bufferTable[index]
+        return np.frombuffer(self.data, dtype=BUFFER_DTYPES[entry['type']],
+                count=entry['count'], offset=self.bodyOffset + entry['offset'])
+
+    def values(self, index):
+        '''returns the buffer at index in the buffer table as a tuple of
+        python numbers, without NumPy.'''
+        entry = self.bufferTable[index]
+        return struct.unpack('<%s%s' % (entry['count'],
+            BUFFER_FORMATS[entry['type']]), self.buffer(index).tobytes())
@@ -0,0 +1,110 @@
+"""
+An in-process cache of site documents for PostSites.
+
+A SiteCache holds the json strings returned by DataSource.getSiteJson,
+keyed by site id and by a fingerprint of the ConfigurationInfo that
+produced them, so that a change to the configuration never serves a
+document built for the old one. It is limited by the total size of the
+documents it holds, and evicts the least recently used ones first.
+
+    >>> ds.enableCache(maxBytes=256 * 1024 * 1024)
+    >>> siteJson = ds.getSiteJson(id=203) # queries the database
+    >>> siteJson = ds.getSiteJson(id=203) # comes from the cache
+    >>> ds.cache.stats()
+    {'hits': 1, 'misses': 1, 'evictions': 0, 'invalidations': 0, 'entries': 1, 'bytes': 48213, 'maxBytes': 268435456}
+
+"""
+# Standard Library imports
+import threading
+from collections import OrderedDict
+
+
+class SiteCache(object):
+    """A thread-safe LRU cache of strings, limited to maxBytes in total."""
+    def __init__(self, maxBytes=64 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # bumped by invalidate(), see put()
+        self.generation = 0
+        self._entries = OrderedDict() # least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __unicode__(self):
+        return 'SiteCache: %s entries, %s of %s bytes' % (len(self._entries),
+                self._bytes, self.maxBytes)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''returns the cached value for key, or None.'''
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                value = self._entries.pop(key)
+                self._entries[key] = value # move it to the back
+                self.hits += 1
+                return value
+            self.misses += 1
+            return None
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, generation=None):
+        '''caches value under key, evicting the least recently used
+        values until everything fits. Values larger than maxBytes are
+        not cached at all. If generation is given (the generation read
+        before value was made) and the cache has been invalidated since,
+        value may be stale and is not cached.'''
+        size = len(value)
+        if size > self.maxBytes:
+            return
+        self._lock.acquire()
+        try:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._bytes -= len(self._entries.pop(key))
+            while self._entries and self._bytes + size > self.maxBytes:
+                oldKey, oldValue = self._entries.popitem(last=False)
+                self._bytes -= len(oldValue)
+                self.evictions += 1
+            self._entries[key] = value
+            self._bytes += size
+        finally:
+            self._lock.release()
+
+    def invalidate(self, match=None):
+        '''removes every entry, or only the entries whose key makes
+        match(key) return True.'''
+        self._lock.acquire()
+        try:
+            if match is None:
+                keys = list(self._entries)
+            else:
+                keys = [key for key in self._entries if match(key)]
+            self.generation += 1
+            for key in keys:
+                self._bytes -= len(self._entries.pop(key))
+            self.invalidations += len(keys)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        '''removes every entry.'''
+        self.invalidate()
+
+    def stats(self):
+        '''returns a dictionary of hit/miss counts and sizes.'''
+        return {'hits':self.hits, 'misses':self.misses,
+                'evictions':self.evictions,
+                'invalidations':self.invalidations,
+                'entries':len(self._entries), 'bytes':self._bytes,
+                'maxBytes':self.maxBytes}
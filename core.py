@@ -1,5 +1,11 @@
 # Standard Library imports
 import os
+import threading
+import time
+import traceback
+from itertools import chain
+from Queue import Queue, Empty
+from hashlib import md5
 
 # Third party imports
 import psycopg2 as pg
@@ -16,10 +22,31 @@ except:
     HAS_SCIPY = False
 
 # local package imports
+import binarysite
 import loader
 import sqls
+import topology
+import wkb
+from pool import ConnectionPool
+from cache import SiteCache
 from json_utils import handler # necessary for handling datetimes
 
+# placeholders and types for the parameters of prepared site queries
+SITE_PARAMS = ('$1', '$2') # site id, site radius
+SITE_PARAM_TYPES = ('bigint', 'float8')
+# placeholders for site queries that are run through psycopg2's own binding
+BOUND_PARAMS = ('%(site_id)s', '%(site_radius)s')
+BATCH_PARAM_TYPES = ('bigint[]', 'float8') # site ids, site radius
+BATCH_KINDS = ('sitesBatch', 'othersitesBatch', 'layerBatch', 'terrainBatch',
+        'originBatch')
+# the queries that can be answered from the tables made by buildSites
+# (the terrain is triangulated from points, so it always uses the
+# spatial query)
+PREBUILT_KINDS = ('site', 'othersites', 'layer', 'sitesBatch',
+        'othersitesBatch', 'layerBatch')
+# the error code PostgreSQL uses for an unknown prepared statement
+INVALID_STATEMENT_NAME = '26000'
+
 SQL_ROOT = os.path.join(os.path.abspath(__file__), 'sqls')
 PLPYTHON_ROOT  = os.path.join(os.path.abspath(__file__), 'plpython')
 
@@ -35,6 +62,9 @@ def dictToLayers(layersDictionary):
         layer.cols = layersDictionary[key]['cols']
         if 'color' in layersDictionary[key]:
             layer.color = layersDictionary[key]['color']
+        for setting in ('precision', 'simplify', 'force2d'):
+            if setting in layersDictionary[key]:
+                setattr(layer, setting, layersDictionary[key][setting])
         layerList.append(layer)
     return layerList
 
@@ -43,7 +73,9 @@ def makeLayerJSON(layer, data):
     geoJSONDict = {'type': 'FeatureCollection', 'features':[]}
     for row in data:
         rawJSON, columnData = row[0], row[1:]
-        geomJSON = json.loads(rawJSON)
+        geomJSON = rawJSON
+        if isinstance(rawJSON, basestring):
+            geomJSON = json.loads(rawJSON)
         attributeDictionary = dict(zip(layer.cols, columnData))
         featureDict = {'type':'Feature'}
         featureDict['geometry'] = geomJSON
@@ -54,52 +86,94 @@ def makeLayerJSON(layer, data):
         layerDict['color'] = layer.color
     return layerDict
 
-def makeTerrainJSON(layer, terrainData):
-    # this should create a different json type. How about
-    # 'MESH'? It will also need to iterate through the
-    # geometry and take out Zs and triangulate
-    if not HAS_SCIPY:
-        print '''NumPy and SciPy must be installed in order to triangulate
-        terrain. Please ensure that both are installed and available on
-        sys.path.'''
+def makeLayerDocument(layer, contents, name=None):
+    """Wraps a FeatureCollection that is already encoded as json (such
+    as one built by sqls.featureCollection) in a Layer, without decoding
+    it. Returns a json string."""
+    parts = ['"type": "Layer"', '"name": %s' % json.dumps(name or layer.name)]
+    if layer.color:
+        parts.append('"color": %s' % json.dumps(layer.color))
+    parts.append('"contents": %s' % contents)
+    return '{%s}' % ', '.join(parts)
+
+def makeFeatureText(layer, row):
+    """Encodes one row of (GeoJSON geometry, col, col, ...) as a json
+    Feature string. A geometry that is already json is used as is."""
+    rawJSON, columnData = row[0], row[1:]
+    if isinstance(rawJSON, dict):
+        rawJSON = json.dumps(rawJSON)
+    attributeDictionary = dict(zip(layer.cols, columnData))
+    return '{"type": "Feature", "geometry": %s, "properties": %s}' % (
+            rawJSON or 'null', json.dumps(attributeDictionary, default=handler))
+
+def triangulateTerrain(terrainData, triangulated=False):
+    """Triangulates the terrain of a site. terrainData is a list of rows
+    of (x array, y array, z array, col array, ...), as returned by
+    sqls.getTerrain, so the points go into numpy arrays in bulk and are
+    triangulated without a python loop over them. If triangulated is
+    True, PostGIS has already triangulated the points (see the 'postgis'
+    terrainEngine), each row has a flat array of face vertex indexes
+    after the z array, and neither NumPy nor SciPy is needed. Returns
+    (coordinates, faces, columns): the (x, y, z) vertices, the triangles
+    of vertex indexes (both as lists, or as NumPy arrays if SciPy did the
+    triangulating) and a list with the values of each column, one per
+    vertex. Returns None if there are no points."""
+    rows = [row for row in terrainData if row[0]]
+    if not rows:
         return
-    from triforce import triangulate
-    layerDict = {'type': 'Layer', 'name':layer.name}
-    geoJSONDict = {'type': 'FeatureCollection', 'features':[]}
-    points2d = []
-    points = []
-    pointAttributes = [] # a list of attribute values for each point
-    for row in terrainData: # each row will contain a point
-        rawJSON, columnData = row[0], row[1:]
-        geomJSON = json.loads(rawJSON)
-        # here is where I should triangulate it.
-        point = geomJSON['coordinates']
-        if len(point) == 3:
-            pointZ = point[2]
-        elif layer.zColumn:
-            pointZ = columnData[layer.cols.index(layer.zColumn)]
-        else:
-            pointZ = 0.0
-        pointX, pointY = point[0], point[1]
-        points2d.append((pointX, pointY))
-        points.append((pointX, pointY, pointZ))
-        # this creates one list for each point
-        pointAttributes.append(columnData)
-    # now triangulate the points2d
-    tris = []
-    for array in triangulate(points2d):
-        face = [int(n) for n in array]
-        tris.append(face)
+    if triangulated:
+        coordinates = []
+        faces = []
+        for row in rows:
+            x, y, z, flatFaces = row[:4]
+            offset = len(coordinates)
+            coordinates.extend([list(point) for point in zip(x, y, z)])
+            flatFaces = [offset + int(n) for n in flatFaces or []]
+            faces.extend([flatFaces[i:i + 3] for i in range(0, len(flatFaces), 3)])
+        columns = zip(*[row[4:] for row in rows])
+    else:
+        if not HAS_SCIPY:
+            print '''NumPy and SciPy must be installed in order to triangulate
+            terrain. Please ensure that both are installed and available on
+            sys.path, or set terrainEngine to 'postgis'.'''
+            return
+        columns = zip(*rows) # a tuple of arrays for each column
+        x, y, z = [np.concatenate([np.asarray(a, dtype=np.float64) for a in arrays])
+                for arrays in columns[:3]]
+        columns = columns[3:]
+        faces = np.zeros((0, 3), dtype=np.int64)
+        if len(x) >= 3:
+            try:
+                faces = qhull.Delaunay(np.column_stack((x, y))).simplices
+            except (qhull.QhullError, ValueError):
+                pass # the points are all in a line, there is no surface
+        coordinates = np.column_stack((x, y, z))
+    columns = [list(chain.from_iterable(arrays)) for arrays in columns]
+    return coordinates, faces, columns
+
+def makeTerrainJSON(layer, terrainData, triangulated=False):
+    """Triangulates the terrain of a site (see triangulateTerrain) into a
+    Layer with a single 'Mesh' feature, whose coordinates are the (x, y,
+    z) vertices and whose faces are triangles of vertex indexes. The
+    properties of the feature map each column to its list of values, one
+    per vertex. Returns None if there are no points."""
+    mesh = triangulateTerrain(terrainData, triangulated)
+    if mesh is None:
+        return
+    coordinates, faces, columns = mesh
+    if not triangulated:
+        coordinates = coordinates.tolist()
+        faces = faces.tolist()
     geomJSON = {'type': 'Mesh'} # a new geoJSON type!
-    geomJSON['coordinates'] = points
-    geomJSON['faces'] = tris
-    transposedAttributes = zip(*pointAttributes) #omg hack!
-    attributeDictionary = dict(zip(layer.cols, transposedAttributes)) # I think this should work
+    geomJSON['coordinates'] = coordinates
+    geomJSON['faces'] = faces
+    attributeDictionary = dict(zip(layer.cols or [], columns))
     featureDict = {'type':'Feature'}
     featureDict['geometry'] = geomJSON
     featureDict['properties'] = attributeDictionary
-    geoJSONDict['features'].append(featureDict)
-    layerDict['contents'] = geoJSONDict
+    layerDict = {'type': 'Layer', 'name':layer.name}
+    layerDict['contents'] = {'type': 'FeatureCollection',
+            'features':[featureDict]}
     if layer.color:
         layerDict['color'] = layer.color
     return layerDict
@@ -109,20 +183,53 @@ class ConfigurationInfo(object):
     def __init__(self):
         self.layers = None
         self.layerLoadResults = None # store results from loading operations
-        # results should store ( layer, loaded:True/False, result message )
+        # results store ( layer, loaded:True/False, result message, seconds )
         self.terrainLayer = None
         self.layerDict = None
         self.siteLayer = None
         self.buildingLayer = None
         self.siteRadius = 100 # a default distance
-        self.useBoundingBox = False # would use bounding box to get data, faster
+        self.useBoundingBox = False # use an indexed bounding box test to get data, faster
+        self.boundingBoxRecheck = False # apply the exact distance test as well
         self.sitePropertiesScript = None
-        self.force2d = False
+        self.force2d = False # drop z values, for layers that don't set force2d
         self.getNearbySites = True
+        self.singleQuery = False # get every layer of a site in one statement
+        self.usePreparedStatements = True # reuse server-side query plans
+        self.serverSideJson = False # let PostGIS build each layer's json
+        self.usePrebuiltSites = False # use the tables made by buildSites
+        # 'scipy' triangulates terrain in python, 'postgis' with ST_DelaunayTriangles
+        self.terrainEngine = 'scipy'
+        # thins out terrain points before triangulating them, a dictionary of
+        # gridSize, rings, maxError and maxVertices (see sqls._decimateTerrain)
+        self.terrainDecimation = None
+        # build site json as a TopoJSON Topology with shared, quantized arcs
+        self.topology = False
+        self.quantization = topology.DEFAULT_QUANTIZATION
+        # 'geojson', or 'wkb' to fetch geometries as binary and decode
+        # them in bulk (see wkb.decode)
+        self.geometryFormat = 'geojson'
 
     def layerByName(self, name):
         return [n for n in self.layers if n.name == name][0]
 
+    def fingerprint(self):
+        """Returns a hash of every setting that affects the json of a
+        site: the layers and their columns, the special layers, the
+        radius and the other options. Settings added later are included
+        automatically."""
+        def describe(value):
+            if isinstance(value, Layer):
+                return sorted([(k, describe(v)) for k, v in vars(value).items()
+                    if k != 'features'])
+            elif isinstance(value, (list, tuple)):
+                return [describe(v) for v in value]
+            return value
+        ignored = ('layerLoadResults', 'layerDict', 'usePreparedStatements')
+        state = [(k, describe(v)) for k, v in sorted(vars(self).items())
+                if k not in ignored]
+        return md5(repr(state)).hexdigest()
+
     def setSiteLayer(self, name):
         self.siteLayer = self.layerByName(name)
         return self
@@ -145,6 +252,10 @@ class Layer(object):
         self.features = None
         self.color = None
         self.zColumn = None
+        # how the GeoJSON of the layer is built, see sqls.outputGeometry
+        self.precision = None # decimal digits, None for PostGIS' default of 9
+        self.simplify = None # a tolerance to simplify geometries with
+        self.force2d = None # None uses ConfigurationInfo.force2d
 
     def __unicode__(self):
         return 'Layer: %s' % self.name
@@ -155,10 +266,9 @@ class Layer(object):
 
 class Site(object):
     """Used to hold information about individual sites."""
-    # Site objects could be pre-generated in order to make
-    # queries faster. There could be a command called
-    # 'buildSites' that would create some tables
-    # and store some site information.
+    # Site information can be pre-generated in order to make
+    # queries faster, see DataSource.buildSites, which creates
+    # some tables and stores the features of each site.
     def __init__(self, id):
         self.id = None
         self.layers = []
@@ -180,6 +290,10 @@ class DataSource(object):
     queries to the databse, using the psycopg2 advice
     that creating separate cursors is cheap, while
     making separate connections is expensive.
+    Connections are borrowed from a ConnectionPool (see pool.py)
+    and handed back after each call, so one DataSource can be
+    shared between threads. The pool is sized with poolMinSize,
+    poolMaxSize and poolIdleTimeout before the first query.
     Should be initialized with a dictionary containing
     database connection information:
     >>> dbinfo = {'user':'me','dbname':'mydb','password':'pa55w0rd'}
@@ -194,10 +308,38 @@ class DataSource(object):
         self.dbpassword = dbinfo['password']
         self.dbinfo = dbinfo
         self.config = ConfigurationInfo()
-        self.connection = None
         self.writeMode = 'overwrite' #'overwrite' or 'append' are only options
         self.skipfailures = False
         self.epsg = 3785 # default epsg, look it up
+        # 'ogr2ogr', or 'copy' to load shapefiles with COPY (see copyloader)
+        self.loaderEngine = 'ogr2ogr'
+        self.copyBatchSize = 50000 # rows per COPY transaction
+        # after loading a layer, add missing indexes and ANALYZE it
+        self.indexAfterLoad = True
+        self.clusterAfterLoad = False # also CLUSTER it on the spatial index
+        # after loading the building, site or terrain layer, store the
+        # terrain z of each building and site (see drapeLayer)
+        self.drapeAfterLoad = False
+        self.drapeColumn = 'terrain_z'
+        self.drapeDistance = None # how far to look for terrain, None for any
+        # connection pool settings, used when the pool is first needed
+        self.poolMinSize = 1
+        self.poolMaxSize = 10
+        self.poolIdleTimeout = 300 # seconds before extra idle connections close
+        self.pool = None
+        self._poolLock = threading.Lock()
+        # guards the configuration while files are loaded in parallel
+        self._loadLock = threading.RLock()
+        self._buildSitesLock = threading.Lock()
+        # what the site tables were built with, see _prebuiltSitesCurrent
+        self._siteInfo = None
+        self._siteInfoWarning = None
+        # each thread borrows its own connection from the pool
+        self._local = threading.local()
+        # compiled query templates, see compileQueries()
+        self._queries = {}
+        # an optional SiteCache of site json, see enableCache()
+        self.cache = None
 
     def __unicode__(self):
         return 'DataSource: dbname=%s' % self.dbname
@@ -205,6 +347,11 @@ class DataSource(object):
     def __str__(self):
         return unicode(self).encode('utf-8')
 
+    @property
+    def connection(self):
+        """The connection currently borrowed by this thread, if any."""
+        return getattr(self._local, 'connection', None)
+
     def _run(self, sql):
         cur = self.connection.cursor()
         cur.execute(sql)
@@ -212,28 +359,104 @@ class DataSource(object):
         cur.close()
         return records
 
+    def _execute(self, sql):
+        """Runs sql that doesn't return any rows, such as an INSERT."""
+        cur = self.connection.cursor()
+        cur.execute(sql)
+        cur.close()
+
+    def _runPrepared(self, sql, types, params):
+        """Runs a query template that uses $1, $2, ... placeholders as a
+        server-side prepared statement, so that PostgreSQL parses and
+        plans it only once per connection. Statements are named after
+        their text and prepared on each connection the first time they
+        are used there, which also covers connections that are replaced
+        after a reconnect."""
+        name = 'postsites_%s' % md5(sql).hexdigest()[:16]
+        connection = self.connection
+        for attempt in range(2):
+            cur = connection.cursor()
+            try:
+                if name not in connection.prepared:
+                    cur.execute('PREPARE %s (%s) AS %s' % (name,
+                        ', '.join(types), sql))
+                    connection.prepared.add(name)
+                placeholders = ', '.join(['%s'] * len(params))
+                cur.execute('EXECUTE %s (%s);' % (name, placeholders), params)
+                records = cur.fetchall()
+                return records
+            except pg.Error, e:
+                # the statement has disappeared from the session
+                # (DISCARD ALL, a server restart, a pooler...), so prepare
+                # it again. psycopg2 raises this as an OperationalError.
+                if attempt > 0 or e.pgcode != INVALID_STATEMENT_NAME:
+                    raise
+                connection.rollback()
+                connection.prepared.discard(name)
+            finally:
+                cur.close()
+
     def _runMultiple(self, sqls):
         datas = []
         self._connect()
-        for sql in sqls:
-            datas.append(self._run(sql))
-        self._close()
+        try:
+            for sql in sqls:
+                datas.append(self._run(sql))
+        finally:
+            self._close()
         return datas
 
     def _connectAndRun(self, sql):
         self._connect()
-        records = self._run(sql)
-        self._close()
+        try:
+            records = self._run(sql)
+        finally:
+            self._close()
         return records
 
-    def _connect(self):
-        connString = 'dbname=%s user=%s password=%s' % (self.dbname,
+    def _connString(self):
+        return 'dbname=%s user=%s password=%s' % (self.dbname,
                 self.dbuser, self.dbpassword)
-        self.connection =  pg.connect(connString)
-        return self.connection
+
+    def _getPool(self):
+        if self.pool is None or self.pool.closed:
+            self._poolLock.acquire()
+            try:
+                if self.pool is None or self.pool.closed:
+                    self.pool = ConnectionPool(self._connString(),
+                            self.poolMinSize, self.poolMaxSize,
+                            self.poolIdleTimeout)
+            finally:
+                self._poolLock.release()
+        return self.pool
+
+    def _connect(self):
+        """Borrows a connection from the pool for the current thread.
+        Calls can be nested, only the outermost call borrows a connection
+        and only the matching outermost _close() gives it back."""
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            # remember the pool, closeConnections() may replace it
+            # before the connection is given back
+            self._local.pool = self._getPool()
+            self._local.connection = self._local.pool.getConnection()
+        self._local.depth = depth + 1
+        return self._local.connection
 
     def _close(self):
-        self.connection.close()
+        """Gives the current thread's connection back to the pool."""
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            connection, pool = self._local.connection, self._local.pool
+            self._local.connection = None
+            self._local.pool = None
+            pool.putConnection(connection)
+
+    def closeConnections(self):
+        """Closes every pooled connection. The DataSource can still be
+        used afterwards, and will open a new pool when it needs one."""
+        if self.pool is not None:
+            self.pool.closeAll()
 
     def renderSQL(self, sqlTemplateName, variableDictionary,
                folder=SQL_ROOT):
@@ -275,17 +498,19 @@ class DataSource(object):
             outList = self.config.layers # this assumes the layers have been setup
         else:
             self._connect() # but if they haven't been setup, then go get them
-            regexMask = '^pg_|^sql_|spatial_ref_sys|geometry_columns'
-            s = "SELECT tablename FROM pg_tables WHERE tablename !~'%s';" % regexMask
-            data = self._run(s)# return a list of the tables in the db
-            c = "SELECT column_name FROM information_schema.columns WHERE table_name = '%s' AND column_name !~'wkb_geometry';"
-            for row in data: # data is a list of tuples
-                layer = Layer(row[0])
-                # now get the column names
-                coldata = self._run(c % layer.name)
-                layer.cols = [col[0] for col in coldata]
-                outList.append(layer) #only one item in each tuple
-            self._close()
+            try:
+                regexMask = '^pg_|^sql_|spatial_ref_sys|geometry_columns'
+                s = "SELECT tablename FROM pg_tables WHERE tablename !~'%s';" % regexMask
+                data = self._run(s)# return a list of the tables in the db
+                c = "SELECT column_name FROM information_schema.columns WHERE table_name = '%s' AND column_name !~'wkb_geometry';"
+                for row in data: # data is a list of tuples
+                    layer = Layer(row[0])
+                    # now get the column names
+                    coldata = self._run(c % layer.name)
+                    layer.cols = [col[0] for col in coldata]
+                    outList.append(layer) #only one item in each tuple
+            finally:
+                self._close()
         dictTemplate = "'%s':{ 'name': '%s', 'cols':[%s]}"
         formattedLayerDicts = [( dictTemplate % (layer.name_in_db, layer.name,
             ', '.join([("'%s'" % r) for r in layer.cols]))) for layer in outList]
@@ -309,124 +534,1213 @@ class DataSource(object):
         layers = dictToLayers(layDict)
         self.config.layers = layers
         self.config.layerDict = layDict
+        self.compileQueries()
         return self.config #return the ConfigurationInfo object
 
+    def _siteSQL(self, kind, layer, id, siteRadius):
+        """Builds the sql for one of the per-site queries. kind is 'site',
+        'othersites', 'layer' or 'terrain' (which need a Layer) or
+        'siteLayers' or 'origin', or one of the BATCH_KINDS, which take an
+        array of site ids."""
+        site_layer = self.config.siteLayer
+        if kind in PREBUILT_KINDS and self._prebuiltSitesCurrent():
+            return self._prebuiltSiteSQL(kind, layer, id)
+        options = self._sqlOptions()
+        if kind in ('layer', 'layerBatch'):
+            options.update(self._geometryOptions(layer))
+        else:
+            options.update(self._geometryOptions(site_layer))
+        if kind == 'site':
+            return sqls.getSite(site_layer.name_in_db, site_layer.cols,
+                    id, siteRadius, **options)
+        elif kind == 'othersites':
+            return sqls.otherSites(site_layer.name_in_db, site_layer.cols,
+                    id, siteRadius, **options)
+        elif kind == 'origin':
+            return sqls.getSiteOrigin(site_layer.name_in_db, id)
+        elif kind == 'layer':
+            return sqls.getLayer(site_layer.name_in_db, layer.name_in_db,
+                    layer.cols, id, siteRadius, **options)
+        elif kind == 'terrain':
+            return sqls.getTerrain(site_layer.name_in_db, layer.name_in_db,
+                    layer.cols, layer.zColumn, id, siteRadius, **options)
+        elif kind == 'siteLayers':
+            otherLayers = [lay for lay in self.config.layers if lay != site_layer]
+            terrainIndex = None
+            terrainZColumn = None
+            if self.config.terrainLayer in otherLayers:
+                terrainIndex = otherLayers.index(self.config.terrainLayer)
+                terrainZColumn = self.config.terrainLayer.zColumn
+            return sqls.getSiteLayers(site_layer.name_in_db, site_layer.cols,
+                    [(lay.name_in_db, lay.cols, self._geometryOptions(lay))
+                        for lay in otherLayers],
+                    id, siteRadius, self.config.getNearbySites,
+                    terrainIndex, terrainZColumn, **options)
+        elif kind.endswith('Document'):
+            # the FeatureCollection for one of the queries above
+            if kind == 'layerDocument':
+                cols = layer.cols
+            else:
+                cols = site_layer.cols
+            rowKind = kind[:-len('Document')]
+            return sqls.featureCollection(
+                    self._siteSQL(rowKind, layer, id, siteRadius), cols)
+        elif kind == 'siteDocuments':
+            return sqls.unionTagged([(index,
+                self._siteSQL(docKind, docLayer, id, siteRadius))
+                for index, docKind, docLayer in self._documentQueries()])
+        elif kind == 'sitesBatch':
+            return sqls.getSites(site_layer.name_in_db, site_layer.cols,
+                    id, siteRadius, **options)
+        elif kind == 'othersitesBatch':
+            return sqls.otherSitesForSites(site_layer.name_in_db,
+                    site_layer.cols, id, siteRadius, **options)
+        elif kind == 'originBatch':
+            return sqls.getSiteOrigins(site_layer.name_in_db, id)
+        elif kind == 'layerBatch':
+            return sqls.getLayerForSites(site_layer.name_in_db,
+                    layer.name_in_db, layer.cols, id, siteRadius, **options)
+        elif kind == 'terrainBatch':
+            return sqls.getTerrainForSites(site_layer.name_in_db,
+                    layer.name_in_db, layer.cols, layer.zColumn, id,
+                    siteRadius, **options)
+
+    def _sqlOptions(self):
+        """The configuration options that change how queries are built,
+        as keyword arguments for the functions in sqls."""
+        return {'useBoundingBox':self.config.useBoundingBox,
+                'boundingBoxRecheck':self.config.boundingBoxRecheck,
+                'terrainEngine':self.config.terrainEngine,
+                'terrainDecimation':self.config.terrainDecimation,
+                'geometryFormat':self.config.geometryFormat}
+
+    def _geometryOptions(self, layer):
+        """The settings of a layer that change its GeoJSON, as keyword
+        arguments for sqls.outputGeometry."""
+        force2d = layer.force2d
+        if force2d is None:
+            force2d = self.config.force2d
+        return {'precision':layer.precision, 'simplify':layer.simplify,
+                'force2d':bool(force2d)}
+
+    def _prebuiltSiteSQL(self, kind, layer, id):
+        """Builds the sql for one of the per-site queries from the site
+        tables made by buildSites."""
+        site_layer = self.config.siteLayer
+        batch = kind in BATCH_KINDS
+        if kind in ('site', 'othersites', 'sitesBatch', 'othersitesBatch'):
+            layer = site_layer
+        options = self._geometryOptions(layer)
+        options['geometryFormat'] = self.config.geometryFormat
+        if kind in ('site', 'sitesBatch'):
+            return sqls.getLayerPrebuilt(site_layer.name_in_db,
+                    site_layer.cols, id, batch, otherSites=False, **options)
+        elif kind in ('othersites', 'othersitesBatch'):
+            return sqls.getLayerPrebuilt(site_layer.name_in_db,
+                    site_layer.cols, id, batch, otherSites=True, **options)
+        else:
+            return sqls.getLayerPrebuilt(layer.name_in_db, layer.cols, id,
+                    batch, **options)
+
+    def _queryKey(self, kind, layer):
+        site_layer = self.config.siteLayer
+        geometry = lambda lay: json.dumps(self._geometryOptions(lay),
+                sort_keys=True)
+        key = [kind, site_layer.name_in_db, tuple(site_layer.cols or []),
+                self._prebuiltSitesCurrent(),
+                json.dumps(self._sqlOptions(), sort_keys=True),
+                geometry(site_layer)]
+        if layer is not None:
+            key.extend([layer.name_in_db, tuple(layer.cols or []),
+                layer.zColumn, geometry(layer)])
+        elif kind in ('siteLayers', 'siteDocuments'):
+            key.append(self.config.getNearbySites)
+            if self.config.terrainLayer:
+                key.extend([self.config.terrainLayer.name_in_db,
+                    self.config.terrainLayer.zColumn])
+            key.extend([(lay.name_in_db, tuple(lay.cols or []), geometry(lay))
+                for lay in self.config.layers])
+        return tuple(key)
+
+    def _compiledSQL(self, kind, layer=None):
+        """Returns the query template for kind and layer, with $1 and $2
+        standing in for the site id and radius, compiling it if the
+        configuration has changed since it was last compiled."""
+        key = self._queryKey(kind, layer)
+        if key not in self._queries:
+            self._queries[key] = self._siteSQL(kind, layer, *SITE_PARAMS)
+        return self._queries[key]
+
+    def compileQueries(self):
+        """Compiles the query templates for every configured layer, so
+        that getSiteJson doesn't have to build sql strings. This is done
+        when a layer dictionary is loaded, and whenever the configuration
+        has changed by the time a query is run."""
+        self._queries = {}
+        site_layer = self.config.siteLayer
+        if not (self.config.layers and site_layer):
+            return self._queries
+        for kind in ('site', 'othersites', 'sitesBatch', 'othersitesBatch',
+                'siteDocument', 'othersitesDocument', 'origin', 'originBatch'):
+            self._compiledSQL(kind)
+        for layer in self.config.layers:
+            if layer == self.config.terrainLayer:
+                for kind in ('terrain', 'terrainBatch'):
+                    self._compiledSQL(kind, layer)
+            elif layer != site_layer:
+                for kind in ('layer', 'layerBatch', 'layerDocument'):
+                    self._compiledSQL(kind, layer)
+        self._compiledSQL('siteLayers')
+        self._compiledSQL('siteDocuments')
+        return self._queries
+
+    def _runSiteQuery(self, kind, id, layer=None):
+        """Runs one of the per-site queries for a site id, or for a list
+        of site ids if kind is one of the BATCH_KINDS."""
+        if self.config.usePreparedStatements:
+            if kind in BATCH_KINDS:
+                types = BATCH_PARAM_TYPES
+            else:
+                types = SITE_PARAM_TYPES
+            return self._runPrepared(self._compiledSQL(kind, layer),
+                    types, (id, self.config.siteRadius))
+        else:
+            if kind in BATCH_KINDS:
+                id = 'ARRAY[%s]::bigint[]' % ', '.join([str(int(i)) for i in id])
+            return self._run(self._siteSQL(kind, layer, id,
+                self.config.siteRadius))
+
+    def enableCache(self, maxBytes=64 * 1024 * 1024):
+        """Keeps up to maxBytes of site json in memory, so that sites
+        that are requested again don't have to be queried again. Cached
+        sites are forgotten whenever a layer is (re)loaded, json that was
+        being built while that happened is not cached, and sites are
+        keyed by a fingerprint of the configuration, so changing the
+        configuration never returns stale json. See cache.SiteCache."""
+        self.cache = SiteCache(maxBytes)
+        return self.cache
+
+    def disableCache(self):
+        self.cache = None
+
+    def _cacheKey(self, id):
+        return (id, self.config.fingerprint())
+
     def getSiteJson(self, id=None):
-        # connect to the database
+        cache = self.cache
+        if cache is not None:
+            key = self._cacheKey(id)
+            # a reload during the query must not leave stale json behind
+            generation = cache.generation
+            siteJson = cache.get(key)
+            if siteJson is not None:
+                return siteJson
+        # borrow a connection from the pool
         self._connect()
-        siteDict = {}
-        siteDict["type"] = "LayerCollection"
-        siteDict["layers"] = []
-        # get the site layer
-        if self.config.siteLayer:
-            site_layer = self.config.siteLayer
+        try:
+            if (self.config.serverSideJson and not self.config.topology and
+                    self.config.geometryFormat == 'geojson'):
+                siteJson = self._getSiteJsonServerSide(id)
+            else:
+                siteJson = json.dumps(self._getSiteDict(id), default=handler)
+        finally:
+            # give the connection back
+            self._close()
+        if cache is not None:
+            cache.put(key, siteJson, generation)
+        return siteJson
+
+    def _documentQueries(self):
+        """Lists (index, kind, layer) for the per-layer FeatureCollection
+        queries used by _getSiteJsonServerSide. The terrain is left out,
+        because it is triangulated in python."""
+        queries = []
+        for index, layer in enumerate(self.config.layers):
+            if layer == self.config.siteLayer:
+                queries.append((index, 'siteDocument', None))
+                if self.config.getNearbySites:
+                    queries.append((sqls.OTHERSITES_INDEX, 'othersitesDocument', None))
+            elif layer != self.config.terrainLayer:
+                queries.append((index, 'layerDocument', layer))
+        return queries
+
+    def _getSiteJsonServerSide(self, id):
+        """Builds the json for a site from FeatureCollections that PostGIS
+        has already encoded (see sqls.featureCollection), so that no
+        feature is decoded or re-encoded in python. Only the terrain
+        still goes through makeTerrainJSON."""
+        documents = {}
+        if self.config.singleQuery:
+            for index, contents, count in self._runSiteQuery('siteDocuments', id):
+                documents[index] = (contents, count)
+        else:
+            for index, kind, layer in self._documentQueries():
+                documents[index] = self._runSiteQuery(kind, id, layer)[0]
+        layerDocs = []
+        for index, layer in enumerate(self.config.layers):
+            if layer == self.config.siteLayer:
+                contents, count = documents[index]
+                layerDocs.append(makeLayerDocument(layer, contents, 'site'))
+                if sqls.OTHERSITES_INDEX in documents:
+                    contents, count = documents[sqls.OTHERSITES_INDEX]
+                    if count > 0: # if there are other sites
+                        layerDocs.append(makeLayerDocument(layer, contents,
+                            'othersites'))
+            elif layer == self.config.terrainLayer:
+                terrainJson = self._makeTerrain(layer,
+                        self._runSiteQuery('terrain', id, layer))
+                if terrainJson is not None:
+                    layerDocs.append(json.dumps(terrainJson, default=handler))
+            else:
+                contents, count = documents[index]
+                if count > 0:
+                    layerDocs.append(makeLayerDocument(layer, contents))
+        return '{"type": "LayerCollection", "layers": [%s]}' % ', '.join(layerDocs)
+
+    def _getSiteDict(self, id):
+        return self._assembleSite(self._fetchSite(id))
+
+    def _fetchSite(self, id):
+        """Gets the rows of every layer of a site, with one query per
+        layer or with a single query (see config.singleQuery)."""
+        if self.config.singleQuery:
+            return self._fetchSiteDataSingleQuery(id)
+        return self._fetchSiteData(id)
+
+    def _fetchSiteData(self, id):
+        """Runs one query per layer, and returns a dictionary of result
+        rows keyed by Layer, plus 'site' and 'othersites' for the
+        site layer."""
+        siteData = {}
+        site_layer = self.config.siteLayer
         # For each layer
         for layer in self.config.layers:
             #print 'Getting Layer %s from PostgreSQL' % layer.name
             if layer == site_layer: # this is the site layer
                 # get the site
-                siteSQL = sqls.getSite(layer.name_in_db, layer.cols,
-                        id, self.config.siteRadius)
-                # execute SQL
-                siteData = self._run(siteSQL) # get the site
-                siteJson = makeLayerJSON(layer, siteData)
-                siteJson["name"] = "site"
-                siteDict["layers"].append( siteJson )
+                siteData['site'] = self._runSiteQuery('site', id)
                 if self.config.getNearbySites:
                     # get the other sites nearby
-                    otherSitesSQL = sqls.otherSites(layer.name_in_db, layer.cols,
-                            id, self.config.siteRadius)
-                    otherSitesData = self._run(otherSitesSQL) # get the other sites
-                    if len(otherSitesData) > 0: # if there are other sites
-                        otherSitesJson = makeLayerJSON(layer, otherSitesData)
-                        otherSitesJson["name"] = "othersites"
-                        siteDict["layers"].append( otherSitesJson )
+                    siteData['othersites'] = self._runSiteQuery('othersites', id)
+            elif layer == self.config.terrainLayer:
+                siteData[layer] = self._runSiteQuery('terrain', id, layer)
+            else: # some other layer
+                siteData[layer] = self._runSiteQuery('layer', id, layer)
+        return siteData
+
+    def _fetchSiteDataSingleQuery(self, id):
+        """Gets every layer for a site in one round trip (see
+        sqls.getSiteLayers), and splits the rows by layer into the same
+        dictionary that _fetchSiteData returns."""
+        site_layer = self.config.siteLayer
+        otherLayers = [lay for lay in self.config.layers if lay != site_layer]
+        keys = dict(enumerate(otherLayers))
+        keys[sqls.SITE_INDEX] = 'site'
+        keys[sqls.OTHERSITES_INDEX] = 'othersites'
+        siteData = {}
+        for layerIndex, rawJSON, columnData in self._runSiteQuery('siteLayers', id):
+            if keys[layerIndex] == self.config.terrainLayer:
+                # the terrain arrays are the whole row
+                row = tuple(columnData)
+            else:
+                # put the rows back in the (geometry, col, col, ...) shape
+                row = (rawJSON,) + tuple(columnData)
+            siteData.setdefault(keys[layerIndex], []).append(row)
+        return siteData
+
+    def _fetchSitesData(self, ids):
+        """Runs one set-based query per layer for a list of site ids, and
+        returns a dictionary that maps each site id to the same kind of
+        dictionary that _fetchSiteData returns for a single site."""
+        sitesData = dict([(id, {}) for id in ids])
+        def split(key, records):
+            for record in records:
+                siteId, row = record[0], record[1:]
+                sitesData[siteId].setdefault(key, []).append(row)
+        site_layer = self.config.siteLayer
+        for layer in self.config.layers:
+            if layer == site_layer:
+                split('site', self._runSiteQuery('sitesBatch', ids))
+                if self.config.getNearbySites:
+                    split('othersites', self._runSiteQuery('othersitesBatch', ids))
+            elif layer == self.config.terrainLayer:
+                split(layer, self._runSiteQuery('terrainBatch', ids, layer))
+            else:
+                split(layer, self._runSiteQuery('layerBatch', ids, layer))
+        return sitesData
+
+    def iterSitesJson(self, ids, batchSize=100):
+        """
+        Generates (id, json) tuples for many sites, in the order of ids.
+        Sites are fetched batchSize at a time, with one query per layer
+        for each batch rather than one query per layer for each site.
+        Each document is the same as the one getSiteJson returns.
+        >>> for id, siteJson in ds.iterSitesJson(range(1, 5001)):
+        ...     open('site_%s.json' % id, 'w').write(siteJson)
+        """
+        ids = list(ids)
+        cache = self.cache
+        for start in range(0, len(ids), batchSize):
+            batch = ids[start:start + batchSize]
+            cached = {}
+            if cache is not None:
+                generation = cache.generation
+                for id in batch:
+                    siteJson = cache.get(self._cacheKey(id))
+                    if siteJson is not None:
+                        cached[id] = siteJson
+            uniqueIds = list(set([int(id) for id in batch if id not in cached]))
+            sitesData = {}
+            if uniqueIds:
+                self._connect()
+                try:
+                    sitesData = self._fetchSitesData(uniqueIds)
+                finally:
+                    self._close()
+            for id in batch:
+                if id in cached:
+                    yield id, cached[id]
+                    continue
+                siteDict = self._assembleSite(sitesData[int(id)])
+                siteJson = json.dumps(siteDict, default=handler)
+                if cache is not None:
+                    cache.put(self._cacheKey(id), siteJson, generation)
+                    cached[id] = siteJson
+                yield id, siteJson
+
+    def getSitesJson(self, ids, batchSize=100):
+        """Returns a dictionary that maps each of the site ids to its
+        json. See iterSitesJson."""
+        return dict(self.iterSitesJson(ids, batchSize))
+
+    def _streamRows(self, connection, kind, id, layer, batchSize):
+        """Generates lists of up to batchSize rows from one of the per-site
+        queries, read through a named (server-side) cursor so that the
+        rows are never all in memory at once."""
+        sql = self._siteSQL(kind, layer, *BOUND_PARAMS)
+        cur = connection.cursor('postsites_stream')
+        try:
+            cur.execute(sql, {'site_id':id, 'site_radius':self.config.siteRadius})
+            while True:
+                rows = cur.fetchmany(batchSize)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cur.close()
+
+    def _streamLayer(self, connection, kind, id, layer, name, batchSize,
+            skipEmpty=True, separator=''):
+        """Generates the json for one layer in chunks of batchSize
+        features. If skipEmpty is True and the layer has no features,
+        nothing is generated at all."""
+        started = False
+        if kind == 'layer':
+            queryLayer = layer
+        else:
+            queryLayer = None
+        for rows in self._streamRows(connection, kind, id, queryLayer, batchSize):
+            features = ', '.join([makeFeatureText(layer, row)
+                for row in self._geometryRows(rows)])
+            if not started:
+                # the contents come last in a layer document, so it
+                # can be left open at the features list
+                opening = makeLayerDocument(layer,
+                        '{"type": "FeatureCollection", "features": [', name)[:-1]
+                started = True
+                yield separator + opening + features
+            else:
+                yield ', ' + features
+        if started:
+            yield ']}}'
+        elif not skipEmpty:
+            yield separator + makeLayerDocument(layer,
+                    '{"type": "FeatureCollection", "features": []}', name)
+
+    def iterSiteJson(self, id, batchSize=1000):
+        """
+        Generates the json for a site in chunks, reading batchSize rows
+        at a time through server-side cursors and encoding the features
+        as they arrive, so that memory use depends on batchSize rather
+        than on the size of the site. Joined together, the chunks are
+        equivalent to getSiteJson(id), except that they are always
+        GeoJSON (see config.topology). The terrain is the exception:
+        all of its points are needed to triangulate it.
+        >>> for chunk in ds.iterSiteJson(203):
+        ...     response.write(chunk)
+        """
+        # the generator may be suspended for a long time, so it borrows
+        # a connection of its own rather than the thread's connection
+        pool = self._getPool()
+        connection = pool.getConnection()
+        try:
+            yield '{"type": "LayerCollection", "layers": ['
+            separator = ''
+            for layer in self.config.layers:
+                if layer == self.config.siteLayer:
+                    layerStreams = [('site', 'site', False)]
+                    if self.config.getNearbySites:
+                        layerStreams.append(('othersites', 'othersites', True))
+                elif layer == self.config.terrainLayer:
+                    terrainData = []
+                    for rows in self._streamRows(connection, 'terrain', id,
+                            layer, batchSize):
+                        terrainData.extend(rows)
+                    terrainJson = self._makeTerrain(layer, terrainData)
+                    if terrainJson is not None:
+                        yield separator + json.dumps(terrainJson, default=handler)
+                        separator = ', '
+                    continue
+                else:
+                    layerStreams = [('layer', None, True)]
+                for kind, name, skipEmpty in layerStreams:
+                    for chunk in self._streamLayer(connection, kind, id, layer,
+                            name, batchSize, skipEmpty, separator):
+                        yield chunk
+                        separator = ', '
+            yield ']}'
+        finally:
+            pool.putConnection(connection)
+
+    def writeSiteJson(self, id, fileObject, batchSize=1000):
+        """Writes the json for a site to a file-like object as it is
+        generated. See iterSiteJson."""
+        for chunk in self.iterSiteJson(id, batchSize):
+            fileObject.write(chunk)
+
+    def _makeTerrain(self, layer, terrainData):
+        """Builds the terrain Layer from the rows of a terrain query,
+        with the configured terrainEngine."""
+        return makeTerrainJSON(layer, terrainData,
+                self.config.terrainEngine == 'postgis')
+
+    def _assembleSite(self, siteData):
+        """Builds the LayerCollection dictionary for a site from the rows
+        returned by _fetchSiteData, in the order of config.layers, or a
+        TopoJSON Topology of the same layers if config.topology is True."""
+        siteDict = {}
+        siteDict["type"] = "LayerCollection"
+        siteDict["layers"] = []
+        for layer in self.config.layers:
+            if layer == self.config.siteLayer:
+                siteJson = makeLayerJSON(layer,
+                        self._geometryRows(siteData.get('site', [])))
+                siteJson["name"] = "site"
+                siteDict["layers"].append( siteJson )
+                otherSitesData = siteData.get('othersites', [])
+                if len(otherSitesData) > 0: # if there are other sites
+                    otherSitesJson = makeLayerJSON(layer,
+                            self._geometryRows(otherSitesData))
+                    otherSitesJson["name"] = "othersites"
+                    siteDict["layers"].append( otherSitesJson )
             elif layer == self.config.terrainLayer:
                 # process the terrain
-                layerSQL = sqls.getLayer(site_layer.name_in_db, layer.name_in_db,
-                        layer.cols, id, self.config.siteRadius)
-                terrainData = self._run(layerSQL)
-                if len(terrainData) > 0:
-                    # this should create a different json type. How about
-                    # 'MESH'?
-                    terrainJson = makeTerrainJSON(layer, terrainData)
+                terrainJson = self._makeTerrain(layer, siteData.get(layer, []))
+                if terrainJson is not None:
                     siteDict["layers"].append(terrainJson)
-
             else: # this is some other layer
-                layerSQL = sqls.getLayer(site_layer.name_in_db, layer.name_in_db,
-                        layer.cols, id, self.config.siteRadius)
-                layerData = self._run(layerSQL)
+                layerData = siteData.get(layer, [])
                 if len(layerData) > 0:
-                    siteDict["layers"].append(makeLayerJSON(layer, layerData))
-        # close connection
-        self._close()
-        return json.dumps(siteDict, default=handler)
+                    siteDict["layers"].append(makeLayerJSON(layer,
+                        self._geometryRows(layerData)))
+        if self.config.topology:
+            return topology.makeTopology(siteDict, self.config.quantization)
+        return siteDict
+
+    def _geometryRows(self, rows):
+        """Decodes the geometries of rows of (geometry, col, col, ...) all
+        at once if they are WKB (see config.geometryFormat), returning the
+        rows with GeoJSON geometry dictionaries instead."""
+        if self.config.geometryFormat != 'wkb' or not rows:
+            return rows
+        geometries = wkb.toGeoJSON(self._decodeWkb([row[0] for row in rows]))
+        return [(geometry,) + tuple(row[1:])
+                for geometry, row in zip(geometries, rows)]
+
+    def _decodeWkb(self, geometries):
+        """Decodes WKB geometries read from the database with wkb.decode,
+        making sure that they are bytea (psycopg2 returns text as str,
+        which would otherwise be read as WKB)."""
+        for geometry in geometries:
+            if isinstance(geometry, basestring):
+                raise ValueError('expected WKB bytea geometries but got text, '
+                        'the query was not built with geometryFormat="wkb"')
+        return wkb.decode(geometries)
+
+    def getSiteBinary(self, id):
+        """
+        Returns a site as a compact binary package (see binarysite)
+        instead of json. It has the same layers as getSiteJson, but the
+        coordinates, ring offsets and attributes of each layer are typed
+        buffers that a client can use without parsing them, and the
+        header has the centroid of the site that the coordinates are
+        relative to. Packages are not cached.
+        >>> package = binarysite.SitePackage(ds.getSiteBinary(203))
+        >>> package.layer('buildings').array('coordinates')
+        """
+        self._connect()
+        try:
+            siteData = self._fetchSite(id)
+            origin = self._runSiteQuery('origin', id)
+        finally:
+            self._close()
+        return self._packSite(id, siteData, origin and origin[0])
+
+    def iterSitesBinary(self, ids, batchSize=100):
+        """Generates (id, package) tuples for many sites, in the order of
+        ids, fetching them batchSize at a time like iterSitesJson does.
+        Each package is the same as the one getSiteBinary returns."""
+        ids = list(ids)
+        for start in range(0, len(ids), batchSize):
+            batch = ids[start:start + batchSize]
+            uniqueIds = list(set([int(id) for id in batch]))
+            self._connect()
+            try:
+                sitesData = self._fetchSitesData(uniqueIds)
+                origins = dict([(siteId, (x, y)) for siteId, x, y
+                    in self._runSiteQuery('originBatch', uniqueIds)])
+            finally:
+                self._close()
+            for id in batch:
+                yield id, self._packSite(id, sitesData[int(id)],
+                        origins.get(int(id)))
+
+    def _packSite(self, id, siteData, origin):
+        """Packs the rows returned by _fetchSiteData into a binary site
+        package, with the same layers, in the same order, as
+        _assembleSite."""
+        def features(layer, rows, name=None):
+            columns = [(col, [row[i + 1] for row in rows])
+                for i, col in enumerate(layer.cols or [])]
+            geometries = [row[0] for row in rows]
+            if self.config.geometryFormat == 'wkb':
+                arrays = self._decodeWkb(geometries)
+            else:
+                arrays = binarysite.featureArrays(geometries)
+            return binarysite.featureLayer(name or layer.name, arrays,
+                    columns, layer.color)
+        layers = []
+        for layer in self.config.layers:
+            if layer == self.config.siteLayer:
+                layers.append(features(layer, siteData.get('site', []), 'site'))
+                otherSitesData = siteData.get('othersites', [])
+                if len(otherSitesData) > 0: # if there are other sites
+                    layers.append(features(layer, otherSitesData, 'othersites'))
+            elif layer == self.config.terrainLayer:
+                mesh = triangulateTerrain(siteData.get(layer, []),
+                        self.config.terrainEngine == 'postgis')
+                if mesh is not None:
+                    coordinates, faces, columns = mesh
+                    layers.append(binarysite.meshLayer(layer.name, coordinates,
+                        faces, zip(layer.cols or [], columns), layer.color))
+            else:
+                layerData = siteData.get(layer, [])
+                if len(layerData) > 0:
+                    layers.append(features(layer, layerData))
+        return binarysite.pack(layers, origin, id)
+
+    def _runPreparedOnce(self, sql, types, params):
+        self._connect()
+        try:
+            records = self._runPrepared(sql, types, params)
+        finally:
+            self._close()
+        return records
+
+    def getInfo(self, layerName, cols, id):
+        """Returns the values of cols for one feature of a layer."""
+        sql = sqls.getInfo(layerName, cols, '$1')
+        return self._runPreparedOnce(sql, ('bigint',), (id,))
+
+    def nearest(self, fromLayerName, withinLayerName, id, cols, searchDistance):
+        """Returns the values of cols for the feature of withinLayerName
+        that is nearest to the centroid of one feature of fromLayerName."""
+        sql = sqls.nearest(fromLayerName, withinLayerName, '$2', '$1', cols)
+        return self._runPreparedOnce(sql, SITE_PARAM_TYPES, (id, searchDistance))
+
+    def nearestZ(self, forLayerName, terrainLayerName, id, searchDistance):
+        """Returns the z value of the terrain point nearest to the
+        centroid of one feature of forLayerName."""
+        sql = sqls.nearestZ(forLayerName, terrainLayerName, '$2', '$1',
+                self._zColumn(terrainLayerName))
+        return self._runPreparedOnce(sql, SITE_PARAM_TYPES, (id, searchDistance))
+
+    def _zColumn(self, layerName):
+        '''returns the zColumn of the configured layer stored in the
+        table layerName, if there is one.'''
+        for layer in self.config.layers or []:
+            if layer.name_in_db == layerName:
+                return layer.zColumn
+
+    def _nearestForSitesSQL(self, layerName, cols, ids, searchDistance):
+        '''returns the query of iterSitesNearest and writeSitesNearest,
+        and its parameters.'''
+        layer = self.config.layerByName(layerName)
+        params = {}
+        idsParam = distanceParam = None
+        if ids is not None:
+            # psycopg2 sends an empty list as an untyped ARRAY[]
+            idsParam = '%(site_ids)s::bigint[]'
+            params['site_ids'] = [int(id) for id in ids]
+        if searchDistance is not None:
+            distanceParam = '%(max_distance)s'
+            params['max_distance'] = searchDistance
+        sql = sqls.nearestForSites(self.config.siteLayer.name_in_db,
+                layer.name_in_db, cols or layer.cols or [], idsParam,
+                distanceParam)
+        return sql, params
+
+    def iterSitesNearest(self, layerName, cols=None, ids=None,
+            searchDistance=None, batchSize=1000):
+        """
+        Generates (site id, col, col, ...) rows with the values of cols
+        (by default the columns of the layer) for the feature of a layer
+        that is nearest to the centroid of each site, or of each of ids.
+        Every site is done by one query, and the rows are read batchSize
+        at a time through a server-side cursor, in no particular order.
+        Sites with nothing within searchDistance are left out.
+        >>> for row in ds.iterSitesNearest('transit_stops', ['name']):
+        ...     writer.writerow(row)
+        """
+        sql, params = self._nearestForSitesSQL(layerName, cols, ids,
+                searchDistance)
+        # like iterSiteJson, the generator borrows a connection of its own
+        pool = self._getPool()
+        connection = pool.getConnection()
+        try:
+            cur = connection.cursor('postsites_nearest')
+            try:
+                cur.execute(sql, params)
+                while True:
+                    rows = cur.fetchmany(batchSize)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                cur.close()
+        finally:
+            pool.putConnection(connection)
+
+    def writeSitesNearest(self, tableName, layerName, cols=None, ids=None,
+            searchDistance=None):
+        """Stores the rows of iterSitesNearest in a table, replacing it
+        if it exists, without sending them from the database. Returns
+        the number of rows."""
+        sql, params = self._nearestForSitesSQL(layerName, cols, ids,
+                searchDistance)
+        self._connect()
+        try:
+            cur = self.connection.cursor()
+            try:
+                cur.execute(sqls.createResultsTable(tableName, sql), params)
+                count = cur.rowcount
+            finally:
+                cur.close()
+            self.connection.commit()
+        finally:
+            self._close()
+        return count
+
+    def drapeLayer(self, layerName, zColumn=None, searchDistance=None):
+        """
+        Stores the z of the terrain point nearest to the centroid of each
+        feature of a layer in a column of the layer (drapeColumn, added
+        if missing), with one query for the whole layer, and adds the
+        column to the columns of the layer so that its site json has it.
+        searchDistance defaults to drapeDistance. This runs
+        automatically after loading the building, site or terrain layer
+        if drapeAfterLoad is True and there is a terrain layer. Raises a
+        ValueError if no terrain layer is configured.
+        >>> ds.drapeLayer('buildings')
+        'terrain_z'
+        """
+        layer = self.config.layerByName(layerName)
+        terrain = self.config.terrainLayer
+        if terrain is None:
+            raise ValueError('no terrain layer configured')
+        zColumn = zColumn or self.drapeColumn
+        if searchDistance is None:
+            searchDistance = self.drapeDistance
+        self._connect()
+        try:
+            self._execute(sqls.drapeLayer(layer.name_in_db, zColumn,
+                terrain.name_in_db, terrain.zColumn, searchDistance))
+            self.connection.commit()
+        finally:
+            self._close()
+        if zColumn not in (layer.cols or []):
+            layer.cols = (layer.cols or []) + [zColumn]
+        if self.cache is not None:
+            self.cache.clear()
+        return zColumn
 
-    def loadDataFile(self, dataFile, verbose=False, skipfailures=False):
-        '''for loading one DataFile object'''
+    def getSiteZ(self, id, layerName, searchDistance=None):
+        """Returns a dictionary of the terrain z of each feature of a
+        layer in a site, by ogc_fid, from one query. searchDistance
+        defaults to drapeDistance. Raises a ValueError if no terrain
+        layer is configured."""
+        layer = self.config.layerByName(layerName)
+        terrain = self.config.terrainLayer
+        if terrain is None:
+            raise ValueError('no terrain layer configured')
+        if searchDistance is None:
+            searchDistance = self.drapeDistance
+        types, params = SITE_PARAM_TYPES, (id, self.config.siteRadius)
+        if searchDistance is not None:
+            types, params = types + ('float8',), params + (searchDistance,)
+        sql = sqls.getLayerZ(self.config.siteLayer.name_in_db,
+                layer.name_in_db, terrain.name_in_db, terrain.zColumn,
+                '$1', '$2', searchDistance is not None and '$3' or None,
+                **self._sqlOptions())
+        return dict(self._runPreparedOnce(sql, types, params))
+
+    def buildSites(self, layerNames=None):
+        """
+        Precomputes which features of each layer belong to each site of
+        the site layer (within config.siteRadius), and the centroid of
+        each site, and stores them in tables in the database. With
+        config.usePrebuiltSites = True, site queries then look features
+        up by site id instead of searching every layer with ST_DWithin.
+        Passing a list of layer names rebuilds only those layers, which
+        is what happens automatically when a layer is reloaded. If the
+        tables haven't been built, or were built with another site layer,
+        siteRadius, useBoundingBox or boundingBoxRecheck, everything is
+        rebuilt instead, and until then site queries don't use them.
+        The terrain layer is skipped, its points are always found with
+        a spatial query.
+        >>> ds.buildSites() # this may take a while
+        >>> ds.config.usePrebuiltSites = True
+        >>> ds.buildSites(['buildings']) # after buildings have changed
+        """
+        site_layer = self.config.siteLayer
+        radius = self.config.siteRadius
+        rebuildAll = (layerNames is None or site_layer.name in layerNames or
+                self.prebuiltSiteInfo() != self._siteInfoWanted())
+        if rebuildAll:
+            layers = self.config.layers # everything depends on the sites
+        else:
+            layers = [self.config.layerByName(name) for name in layerNames]
+        # see PREBUILT_KINDS, nothing reads the members of the terrain
+        layers = [layer for layer in layers
+                if layer != self.config.terrainLayer]
+        # layers loaded in parallel must not rebuild the tables at once
+        self._buildSitesLock.acquire()
+        try:
+            self._connect()
+            try:
+                self._execute(sqls.createSiteTables())
+                if rebuildAll:
+                    self._execute(sqls.buildSiteCentroids(site_layer.name_in_db,
+                        radius, **self._sqlOptions()))
+                for layer in layers:
+                    self._execute(sqls.buildSiteMembers(site_layer.name_in_db,
+                        layer.name_in_db, radius, **self._sqlOptions()))
+                self.connection.commit()
+            finally:
+                self._close()
+                self._siteInfo = None # read it again when it's needed
+        finally:
+            self._buildSitesLock.release()
+        if self.cache is not None:
+            self.cache.clear()
+        return [layer.name for layer in layers]
+
+    def prebuiltSiteInfo(self):
+        """Returns a dictionary of the site layer, site radius and
+        withinSite options (useBoundingBox and boundingBoxRecheck) that
+        the site tables were last built with, or None if they haven't
+        been built."""
+        self._connect()
+        try:
+            if not self._run(sqls.siteInfoTableExists())[0][0]:
+                return None
+            records = self._run(sqls.getSiteInfo())
+        finally:
+            self._close()
+        if records:
+            info = json.loads(records[0][0])
+            return {'siteLayer':info.get('site_layer'),
+                    'siteRadius':info.get('site_radius'),
+                    'useBoundingBox':info.get('use_bounding_box'),
+                    'boundingBoxRecheck':info.get('bounding_box_recheck')}
+
+    def _siteInfoWanted(self):
+        """The prebuiltSiteInfo that matches the configuration."""
+        return {'siteLayer':self.config.siteLayer.name_in_db,
+                'siteRadius':float(self.config.siteRadius),
+                'useBoundingBox':bool(self.config.useBoundingBox),
+                'boundingBoxRecheck':bool(self.config.boundingBoxRecheck)}
+
+    def _prebuiltSitesCurrent(self):
+        """Whether site queries should use the site tables: only if
+        config.usePrebuiltSites is set and the tables were built for the
+        current configuration. Otherwise the spatial queries are used,
+        with a warning, until buildSites is run."""
+        if not (self.config.usePrebuiltSites and self.config.siteLayer):
+            return False
+        if self._siteInfo is None:
+            self._siteInfo = self.prebuiltSiteInfo() or {}
+        wanted = self._siteInfoWanted()
+        if self._siteInfo == wanted:
+            return True
+        if self._siteInfoWarning != wanted:
+            self._siteInfoWarning = wanted
+            print ('The site tables are missing or were built for another '
+                   'configuration, run buildSites() to use them.')
+        return False
+
+    def _layerIndexes(self, layerName):
+        """Returns the names of the spatial (GiST on wkb_geometry) and id
+        (on ogc_fid) indexes of a table, None for missing ones. Must be
+        called with a connection."""
+        spatialIndex = idIndex = None
+        for index, column, method in self._run(sqls.layerIndexes(layerName)):
+            if column == 'wkb_geometry' and method == 'gist':
+                spatialIndex = index
+            elif column == 'ogc_fid':
+                idIndex = index
+        return spatialIndex, idIndex
+
+    def indexLayer(self, layerName, cluster=False, analyze=True):
+        """
+        Makes sure a layer has the indexes that site queries rely on: a
+        GiST index on wkb_geometry and an index on ogc_fid. Optionally
+        CLUSTERs the table on the spatial index, so that nearby features
+        are stored together, and then runs ANALYZE so that the planner
+        has fresh statistics. Returns a list of what was done.
+        This runs automatically after a layer is loaded (see
+        indexAfterLoad and clusterAfterLoad).
+        >>> ds.indexLayer('buildings', cluster=True)
+        ['CREATE INDEX buildings_wkb_geometry_geom_idx', 'CLUSTER', 'ANALYZE']
+        """
+        tableName = self.config.layerByName(layerName).name_in_db
+        done = []
+        self._connect()
+        try:
+            spatialIndex, idIndex = self._layerIndexes(tableName)
+            if spatialIndex is None:
+                self._execute(sqls.createSpatialIndex(tableName))
+                spatialIndex = '%s_wkb_geometry_geom_idx' % tableName
+                done.append('CREATE INDEX %s' % spatialIndex)
+            if idIndex is None:
+                self._execute(sqls.createIdIndex(tableName))
+                done.append('CREATE INDEX %s_ogc_fid_idx' % tableName)
+            if cluster:
+                self._execute(sqls.clusterLayer(tableName, spatialIndex))
+                done.append('CLUSTER')
+            if analyze:
+                self._execute(sqls.analyzeLayer(tableName))
+                done.append('ANALYZE')
+            self.connection.commit()
+        finally:
+            self._close()
+        return done
+
+    def auditIndexes(self, layerNames=None, verbose=True):
+        """
+        Checks every configured layer (or the named ones) for missing
+        spatial and id indexes and for stale statistics, without
+        changing anything. Returns a list of dictionaries, one per layer,
+        and prints a report if verbose is True.
+        >>> report = ds.auditIndexes()
+        parcels: analyzed 2012-06-01 12:00:00, 0 changes since
+        buildings: MISSING spatial index; never analyzed
+        """
+        if layerNames is None:
+            layers = self.config.layers
+        else:
+            layers = [self.config.layerByName(name) for name in layerNames]
+        report = []
+        self._connect()
+        try:
+            for layer in layers:
+                spatialIndex, idIndex = self._layerIndexes(layer.name_in_db)
+                statistics = self._run(sqls.layerStatistics(layer.name_in_db))
+                if statistics:
+                    lastAnalyzed, changes = statistics[0]
+                else:
+                    lastAnalyzed, changes = None, None
+                report.append({'layer':layer.name, 'spatialIndex':spatialIndex,
+                    'idIndex':idIndex, 'lastAnalyzed':lastAnalyzed,
+                    'changesSinceAnalyze':changes})
+        finally:
+            self._close()
+        if verbose:
+            for entry in report:
+                problems = []
+                if not entry['spatialIndex']:
+                    problems.append('MISSING spatial index')
+                if not entry['idIndex']:
+                    problems.append('MISSING id index')
+                if entry['lastAnalyzed'] is None:
+                    problems.append('never analyzed')
+                else:
+                    problems.append('analyzed %s, %s changes since' % (
+                        entry['lastAnalyzed'], entry['changesSinceAnalyze']))
+                print '%s: %s' % (entry['layer'], '; '.join(problems))
+        return report
+
+    def _afterLayerLoad(self, layer, crossLayer=True):
+        """Runs after all the files of a layer have been loaded. With
+        crossLayer=False only the work on the layer itself (indexing) is
+        done, and the steps that read other layers are left to
+        _afterLayersLoad."""
+        if self.indexAfterLoad:
+            self.indexLayer(layer.name, cluster=self.clusterAfterLoad)
+        if crossLayer:
+            self._afterLayersLoad([layer])
+
+    def _afterLayersLoad(self, layers):
+        """Runs the post-load steps that read other layers (draping, see
+        drapeLayer, and rebuilding the site tables, see buildSites) once
+        for a list of newly loaded layers."""
+        if self.drapeAfterLoad and self.config.terrainLayer:
+            draped = [self.config.buildingLayer, self.config.siteLayer]
+            if self.config.terrainLayer not in layers:
+                draped = [lay for lay in draped if lay in layers]
+            for drapedLayer in draped:
+                if drapedLayer:
+                    self.drapeLayer(drapedLayer.name)
+        if self.config.usePrebuiltSites and self.config.siteLayer:
+            names = [lay.name for lay in layers
+                    if lay != self.config.terrainLayer]
+            if names:
+                self.buildSites(names)
+
+    def loadedFiles(self):
+        '''returns a dictionary of the files that each layer was last
+        loaded from with loadDataFiles, as lists of (file path,
+        fingerprint) tuples in load order (see DataFile.fingerprint).'''
+        loaded = {}
+        self._connect()
+        try:
+            self._execute(sqls.createLoadedFilesTable())
+            self.connection.commit()
+            for layer, filePath, fingerprint in self._run(sqls.getLoadedFiles()):
+                loaded.setdefault(layer, []).append((filePath, fingerprint))
+        finally:
+            self._close()
+        return loaded
+
+    def _recordLoadedFiles(self, layerName, files=None):
+        '''replaces the recorded files of a layer with a list of
+        (file path, fingerprint) tuples, or forgets them if files is None.
+        Forgetting doesn't create the table, so databases that are never
+        loaded incrementally don't get one.'''
+        self._connect()
+        try:
+            cur = self.connection.cursor()
+            try:
+                if files is None:
+                    cur.execute(sqls.loadedFilesTableExists())
+                    if not cur.fetchone()[0]:
+                        return
+                cur.execute(sqls.createLoadedFilesTable())
+                cur.execute(sqls.forgetLoadedFiles(), {'layer':layerName})
+                for position, (filePath, fingerprint) in enumerate(files or []):
+                    cur.execute(sqls.recordLoadedFile(), {'layer':layerName,
+                        'position':position, 'file_path':filePath,
+                        'fingerprint':fingerprint})
+            finally:
+                cur.close()
+            self.connection.commit()
+        finally:
+            self._close()
+
+    def _configureLayer(self, dataFile, skipfailures=False):
+        '''adds the layer of a DataFile to the configuration, or updates
+        it, and returns the Layer.'''
+        self._loadLock.acquire()
+        try:
+            # make sure some layers exist
+            if not self.config.layers:
+                self.config.layers = []
+            # if a layer with that name exists, get it
+            if dataFile.destLayer in [lay.name for lay in self.config.layers]:
+                layer = self.config.layerByName(dataFile.destLayer)
+            else:
+                print 'New Layer:', dataFile.destLayer
+                # make a Layer object
+                layer = Layer(dataFile.destLayer)
+            # we're building the db, so this will be true
+            layer.name_in_db = layer.name
+            # get configuration info from the DataFile
+            if dataFile.isTerrainLayer:
+                self.config.terrainLayer = layer
+            if dataFile.isBuildingLayer:
+                self.config.buildingLayer = layer
+            if dataFile.isSiteLayer:
+                self.config.siteLayer = layer
+            if dataFile.zField:
+                layer.zColumn = dataFile.zField
+            # put it in the configuration layer list
+            if layer not in self.config.layers:
+                self.config.layers.append(layer)
+            # set skipfailures
+            if skipfailures:
+                self.skipfailures = True
+        finally:
+            self._loadLock.release()
+        return layer
+
+    def loadDataFile(self, dataFile, verbose=False, skipfailures=False,
+            postLoad=True, writeMode=None):
+        '''for loading one DataFile object. If postLoad is True, the
+        layer's post-load work (such as rebuilding its site tables) is
+        done after the file has been loaded. writeMode defaults to
+        self.writeMode.'''
         if 'PGCLIENTENCODING' not in os.environ:
             os.environ['PGCLIENTENCODING'] = 'LATIN1'
-        # make sure some layers exist
-        if not self.config.layers:
-            self.config.layers = []
-        # if a layer with that name exists, get it
-        if dataFile.destLayer in [lay.name for lay in self.config.layers]:
-            layer = self.config.layerByName(dataFile.destLayer)
-        else:
-            print 'New Layer:', dataFile.destLayer
-            # make a Layer object
-            layer = Layer(dataFile.destLayer)
-        # we're building the db, so this will be true
-        layer.name_in_db = layer.name
-        # get configuration info from the DataFile
-        if dataFile.isTerrainLayer:
-            self.config.terrainLayer = layer
-        if dataFile.isBuildingLayer:
-            self.config.buildingLayer = layer
-        if dataFile.isSiteLayer:
-            self.config.siteLayer = layer
-        if dataFile.zField:
-            layer.zColumn = dataFile.zField
-        # put it in the configuration layer list
-        self.config.layers.append(layer)
-        # set skipfailures
-        if skipfailures:
-            self.skipfailures = True
+        layer = self._configureLayer(dataFile, skipfailures)
+        # the layer no longer matches the files recorded for it, if any,
+        # until an incremental loadDataFiles records them again
+        self._recordLoadedFiles(layer.name)
         # now load it
-        result = dataFile._load(self)
+        result = dataFile._load(self, writeMode)
+        # cached sites may include features of the old layer
+        if self.cache is not None:
+            self.cache.clear()
+        if postLoad and result[0]:
+            self._afterLayerLoad(layer)
         # this part should better report progress and stuff
         if verbose:
             print result
         return result
 
-    def loadDataFiles(self, dataFiles, verbose=False, skipfailures=False):
-        '''for loading multiple DataFile objects.'''
+    def _loadLayerFiles(self, indexedFiles, verbose, skipfailures,
+            recorded=None, incremental=False):
+        """Loads the files of one layer in order, the first one with
+        'overwrite' and the rest with 'append', and returns a list of
+        (index, (success, output), seconds) and whether the layer was
+        loaded. With incremental=True the files are fingerprinted, and
+        if recorded matches the fingerprints (see loadedFiles) the layer
+        is only configured and not loaded again, otherwise the
+        fingerprints are recorded after a successful load. Without it,
+        the files are not read to fingerprint them.
+        Only the layer's own post-load work is done here, loadDataFiles
+        does the rest once every layer has been loaded."""
+        layerName = indexedFiles[0][1].destLayer
+        files = None
+        if incremental:
+            try:
+                files = [(df.filePath, df.fingerprint(self))
+                        for index, df in indexedFiles]
+            except (IOError, OSError):
+                pass # loading will report the problem
+        if recorded is not None and files == recorded:
+            for index, df in indexedFiles:
+                self._configureLayer(df, skipfailures)
+            return [(index, (True, 'unchanged, not reloaded: %s' % df.filePath), 0.0)
+                    for index, df in indexedFiles], False
+        results = []
+        for n, (index, df) in enumerate(indexedFiles):
+            if n == 0: # new layer
+                writeMode = 'overwrite'
+            else: # existing layer
+                writeMode = 'append'
+            start = time.time()
+            try:
+                result = self.loadDataFile(df, verbose, skipfailures,
+                        False, writeMode)
+                # post-load work waits for the last file of the layer
+                if result[0] and n == len(indexedFiles) - 1:
+                    self._afterLayerLoad(self.config.layerByName(layerName),
+                            crossLayer=False)
+            except Exception:
+                result = (False, traceback.format_exc())
+            results.append((index, result, time.time() - start))
+        success = all([r[1][0] for r in results])
+        if files is not None and success:
+            self._recordLoadedFiles(layerName, files)
+        return results, success
+
+    def loadDataFiles(self, dataFiles, verbose=False, skipfailures=False,
+            workers=1, incremental=False):
+        '''for loading multiple DataFile objects. The first file of each
+        layer overwrites the layer, and the following files are appended
+        to it. With workers > 1, that many layers are loaded at the same
+        time (the files of one layer are still loaded one after another).
+        With incremental=True, the files and fingerprints of each loaded
+        layer are recorded in the database, and layers whose files are
+        all unchanged since they were last recorded are skipped.
+        Fingerprinting reads every file, so it is only done with
+        incremental=True. Draping and rebuilding the
+        site tables are done once all the layers have been loaded.
+        Returns a (success, output) tuple for each file, in the order of
+        dataFiles, and stores (layer, success, output, seconds) tuples in
+        config.layerLoadResults.'''
         if 'PGCLIENTENCODING' not in os.environ:
             os.environ['PGCLIENTENCODING'] = 'LATIN1'
-        loadedLayers = []
-        return_vals = []
-        for df in dataFiles:
-            if df.destLayer in loadedLayers: # existing layer
-                self.writeMode = 'append'
-            else: # new layer
-                self.writeMode = 'overwrite'
-                loadedLayers.append(df.destLayer)
-            # load the file, what is returned?
-            return_vals.append( self.loadDataFile( df, verbose, skipfailures ))
-        return return_vals
-
-
-def makeXlsConfigurationFile( folder, filePath=None ):
-
-    dd = loader.DataDirectory( folder ) # this should make a DatSource object and
+        loaded = {}
+        if incremental:
+            loaded = self.loadedFiles()
+        # group the files by layer, keeping their order
+        layerNames = []
+        layerFiles = {}
+        for i, df in enumerate(dataFiles):
+            if df.destLayer not in layerFiles:
+                layerNames.append(df.destLayer)
+                layerFiles[df.destLayer] = []
+            layerFiles[df.destLayer].append((i, df))
+        results = []
+        reloaded = [] # layers that were loaded, for the post-load steps
+        if workers <= 1:
+            for name in layerNames:
+                layerResults, success = self._loadLayerFiles(layerFiles[name],
+                    verbose, skipfailures, loaded.get(name), incremental)
+                results.extend(layerResults)
+                if success:
+                    reloaded.append(name)
+        else:
+            jobs = Queue()
+            for name in layerNames:
+                jobs.put(layerFiles[name])
+            def work():
+                while True:
+                    try:
+                        indexedFiles = jobs.get_nowait()
+                    except Empty:
+                        return
+                    name = indexedFiles[0][1].destLayer
+                    layerResults, success = self._loadLayerFiles(indexedFiles,
+                            verbose, skipfailures, loaded.get(name),
+                            incremental)
+                    self._loadLock.acquire()
+                    try:
+                        results.extend(layerResults)
+                        if success:
+                            reloaded.append(name)
+                    finally:
+                        self._loadLock.release()
+            threads = [threading.Thread(target=work) for n in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        results.sort()
+        self.config.layerLoadResults = [(dataFiles[index].destLayer,
+            result[0], result[1], seconds) for index, result, seconds in results]
+        # draping and rebuilding the site tables read other layers, so
+        # they wait until no layer is still being loaded
+        self._afterLayersLoad([self.config.layerByName(name)
+            for name in layerNames if name in reloaded])
+        return [result for index, result, seconds in results]
+
+
+def makeXlsConfigurationFile( folder, filePath=None, workers=1, manifest=None ):
+
+    dd = loader.DataDirectory( folder, workers, manifest ) # this should make a DatSource object and
     #read everything.
     return dd.makeXlsConfig( filePath )
 
 def loadFromXlsConfigurationFile( xlsFile, dbinfo, destinationEPSG=3785,
-                                  verbose=False, skipfailures=False):
-    projections, files = loader.parseXlsFile( xlsFile )
+                                  verbose=False, skipfailures=False, workers=1,
+                                  manifest=None, incremental=False):
+    projections, files = loader.parseXlsFile( xlsFile, manifest )
     ds = DataSource( dbinfo )
     ds.epsg = destinationEPSG
-    results = ds.loadDataFiles( files, verbose, skipfailures )
+    results = ds.loadDataFiles( files, verbose, skipfailures, workers,
+                                incremental )
     return ds, results
 
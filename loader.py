@@ -26,9 +26,19 @@ Planned Use:
 # Standard Library Imports
 import os
 import sys
+import threading
+from hashlib import md5
 from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
+try: #try to import json
+    import json #json is in python 2.6 and later standard libraries
+except: #if json doesn't work, try simplejson
+    import simplejson as json
 from pprint import pprint, pformat
 
+# Local Imports
+import shpreader
+
 # Third Party Imports
 try:
     import xlwt
@@ -76,6 +86,14 @@ xlsInfo = {'proj_cols':[
                 "z field",]
         }
 
+# where scan results are kept between runs, see ScanManifest
+DEFAULT_MANIFEST = os.path.join(os.path.expanduser('~'), '.postsites_manifest.json')
+# the files of a shapefile that scan results depend on
+MANIFEST_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj']
+# the DataFile attributes that are kept in the manifest
+MANIFEST_ATTRIBUTES = ['defaultName', 'shpType', 'baseWkt', 'featureCount',
+        'bbox', 'fields']
+
 def cvars(obj):
     v = vars(obj)
     d = {}
@@ -91,7 +109,7 @@ def runArgs(args):
     return p.communicate() # returns (stdout, stderr)
 
 def getShpFiles(folder):
-    """this function returns a list of all the
+    """this function returns a sorted list of all the
     shapefiles contained within the input folder
     including the subfolders of that folder"""
     shpList = []
@@ -102,7 +120,100 @@ def getShpFiles(folder):
         for f in files:
             if f[-4:] == '.shp':
                 shpList.append(os.path.join(dirPath, f))
-    return shpList
+    return sorted(shpList)
+
+
+class ScanManifest(object):
+    '''A ScanManifest remembers what was read from each file (layer name,
+    shape type and .prj WKT), keyed by the file's path and by the size and
+    modification time of its .shp, .shx, .dbf and .prj files. DataFiles
+    that are made with a manifest only read files that are new or have
+    changed since they were last read, so re-running a configuration and
+    loading cycle on an unchanged folder doesn't run ogrinfo at all.
+    The manifest is a json file, ~/.postsites_manifest.json by default.
+    Nothing uses a manifest unless it is asked to, see openManifest.'''
+    def __init__(self, path=DEFAULT_MANIFEST):
+        self.path = path
+        self.entries = {}
+        self.changed = False
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                self.entries = json.load(open(path, 'r'))
+            except ValueError:
+                print 'Ignoring unreadable scan manifest at %s' % path
+
+    def _signature(self, filePath):
+        base = os.path.splitext(filePath)[0]
+        signature = []
+        for ext in MANIFEST_EXTENSIONS:
+            if os.path.exists(base + ext):
+                stat = os.stat(base + ext)
+                signature.append([ext, stat.st_size, stat.st_mtime])
+        return signature
+
+    def lookup(self, filePath):
+        '''returns the saved attributes of a file, or None if the file
+        hasn't been read before or has changed since.'''
+        entry = self.entries.get(filePath)
+        if (entry and entry['signature'] == self._signature(filePath) and
+                set(MANIFEST_ATTRIBUTES) <= set(entry['attributes'])):
+            attributes = {}
+            for name, value in entry['attributes'].items():
+                attributes[str(name)] = _fromJson(value)
+            return attributes
+        return None
+
+    def record(self, dataFile):
+        '''saves the attributes that were read from a DataFile.'''
+        attributes = dict([(name, getattr(dataFile, name, None))
+            for name in MANIFEST_ATTRIBUTES])
+        entry = {'signature':self._signature(dataFile.filePath),
+                 'attributes':attributes}
+        self._lock.acquire()
+        try:
+            self.entries[dataFile.filePath] = entry
+            self.changed = True
+        finally:
+            self._lock.release()
+
+    def save(self):
+        '''writes the manifest to its file, if anything has changed.'''
+        if not self.changed:
+            return
+        tmpPath = self.path + '.tmp'
+        try:
+            f = open(tmpPath, 'w')
+            json.dump(self.entries, f)
+            f.close()
+            if os.path.exists(self.path) and sys.platform == 'win32':
+                os.remove(self.path) # rename doesn't replace files on Windows
+            os.rename(tmpPath, self.path)
+            self.changed = False
+        except (IOError, OSError), e:
+            print 'Could not save the scan manifest to %s: %s' % (self.path, e)
+
+def _fromJson(value):
+    '''json gives back unicode strings and lists, but DataFile attributes
+    are utf-8 strings and tuples.'''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return tuple([_fromJson(v) for v in value])
+    return value
+
+def openManifest(manifest=None):
+    '''returns a ScanManifest for the manifest argument of DataDirectory,
+    parseXlsFile and others: None or False for no manifest at all (the
+    default), True for the default manifest (DEFAULT_MANIFEST), a path,
+    or a ScanManifest.'''
+    if manifest is None or manifest is False:
+        return None
+    if manifest is True:
+        return ScanManifest()
+    if isinstance(manifest, ScanManifest):
+        return manifest
+    return ScanManifest(manifest)
 
 
 class Projection(object):
@@ -141,13 +252,27 @@ class DataFile(object):
     '''A DataFile obect holds information about a particular file of GIS data,
     and can be used to configure the way that the file should be loaded into
     the database.'''
-    def __init__(self, filePath): # must be tied to a real file
+    def __init__(self, filePath, manifest=None): # must be tied to a real file
         self.fp = os.path.abspath(filePath) # make sure the path is a good one
         self.filePath = self.fp # shortcut !
-        # ._readInfo fails silently, needs error raising.
+        # ._readInfo doesn't raise, it stores any error in readError
         self.baseWkt = None
         self.proj = None
-        self._readInfo() # this sets many attributes
+        self.readError = None
+        self.featureCount = None
+        self.bbox = None # (xmin, ymin, xmax, ymax)
+        self.fields = None # dbf fields, as (name, type, length, decimals)
+        # a ScanManifest can save us from reading the file again
+        saved = None
+        if manifest is not None:
+            saved = manifest.lookup(self.filePath)
+        if saved is not None:
+            for name in saved:
+                setattr(self, name, saved[name])
+        else:
+            self._readInfo() # this sets many attributes
+            if manifest is not None and not self.readError:
+                manifest.record(self)
         self.hasProj = bool(self.baseWkt or self.proj)
 
         ## these attributes depend on a user's configuration and preferences
@@ -172,32 +297,87 @@ class DataFile(object):
     def _readInfo(self):
         '''called by __init__, reads info from file to populate attribute values.
         sets defaultName, shpType, and calls _getProj to try to get projection.
+        Shapefiles are read directly (see shpreader), which also sets
+        featureCount, bbox and fields. Other files, or shapefiles that
+        can't be read that way, are read with ogrinfo (see _readInfoOgr).'''
+        if os.path.splitext(self.filePath)[1].lower() == '.shp':
+            try:
+                info = shpreader.readInfo(self.filePath)
+            except (IOError, ValueError):
+                pass # let ogrinfo have a go
+            else:
+                self.defaultName = info['defaultName']
+                self.destLayer = self.defaultName
+                self.shpType = info['shpType']
+                self.featureCount = info['featureCount']
+                self.bbox = info['bbox']
+                self.fields = info['fields']
+                self._readProj()
+                return
+        return self._readInfoOgr()
+
+    def _readInfoOgr(self):
+        '''reads the layer name and shape type with ogrinfo.
         this method depnds on having ogrinfo available on the system PATH. This
         needs lots of error catching because it depends on good input and
         having lots of tools available.'''
         args = ['ogrinfo', '-ro', ('"%s"' % self.filePath)]
         out, err = runArgs( ' '.join(args) )
         if len(err) > 0: # if there's an error
+            self.readError = err
             return err # return the error
         else:
             try:
                 rlayName, rshpType = out.split('\n')[2].split(' (') # read ogrinfo results
             except:
-                return 'Error running command: %s' % args
+                self.readError = 'Error running command: %s' % args
+                return self.readError
             self.defaultName = rlayName.split()[1]
             self.destLayer = self.defaultName
             self.shpType = rshpType.split(')')[0]
             self._readProj()
 
+    def fingerprint(self, dataSource):
+        '''returns an md5 of the contents of the file (all the files of a
+        shapefile) and of the settings that decide what loading it into
+        dataSource produces. DataSource.loadDataFiles compares it with
+        the fingerprint recorded at the last load to skip unchanged layers.'''
+        digest = md5()
+        base, ext = os.path.splitext(self.filePath)
+        paths = [self.filePath]
+        if ext.lower() == '.shp':
+            paths = [base + e for e in MANIFEST_EXTENSIONS]
+        for path in paths:
+            if not os.path.exists(path):
+                digest.update('missing %s' % path)
+                continue
+            f = open(path, 'rb')
+            try:
+                while True:
+                    chunk = f.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+            finally:
+                f.close()
+        epsg = None
+        if self.proj:
+            epsg = self.proj.epsg
+        digest.update(repr((self.destLayer, getattr(self, 'shpType', None), self.zField, epsg,
+            dataSource.epsg)))
+        return digest.hexdigest()
+
     # this method should be called to load the file
     # and only after the loading has been configured
-    def _getLoadArgs(self, dataSource):
+    def _getLoadArgs(self, dataSource, writeMode=None):
         u, db, pw = dataSource.dbinfo['user'], dataSource.dbinfo['dbname'], dataSource.dbinfo['password']
+        if writeMode is None:
+            writeMode = dataSource.writeMode
         args = ['ogr2ogr',
                 '-t_srs "EPSG:%s"' % dataSource.epsg,
                 '-s_srs "EPSG:%s"' % self.proj.epsg,
                 '-f "PostgreSQL"',
-                '-%s' % dataSource.writeMode, #'-append', or '-overwrite'
+                '-%s' % writeMode, #'-append', or '-overwrite'
                 'PG:"user=%s dbname=%s password=%s"' % (u, db, pw),
                 '"%s"' % self.filePath,
                 # dbf files falsely claim precisions, the next arg deals with that
@@ -211,9 +391,14 @@ class DataFile(object):
             args.append('-zfield %s' % self.zField )
         return args
 
-    def _load(self, dataSource):
+    def _load(self, dataSource, writeMode=None):
+        if dataSource.loaderEngine == 'copy':
+            import copyloader # needs psycopg2, which the rest of this module doesn't
+            if copyloader.canLoad(self.filePath):
+                return copyloader.loadShapefile(self, dataSource,
+                        shpTypeDict[self.shpType], writeMode)
         # depends on subprocess module
-        args = self._getLoadArgs( dataSource ) # this needs to be a list, not a string
+        args = self._getLoadArgs( dataSource, writeMode ) # this needs to be a list, not a string
         # use subprocess to run cmd
         out, err = runArgs(' '.join(args)) # I thought Popen could join these better, but it doesn't :(
         if len(err) > 0: # if there's an error
@@ -222,7 +407,7 @@ class DataFile(object):
             return True, out
 
     def _getProjArgs(self, to_epsg, from_epsg, destFilePath, ogrDataFormat):
-		"""This function sets up commands for reprojecting shapefiles, testing github"""
+        """This function sets up commands for reprojecting shapefiles, testing github"""
         args = ['ogr2ogr',
                 '-t_srs "EPSG:%s"' % to_epsg,
                 '-s_srs "EPSG:%s"' % from_epsg,
@@ -256,13 +441,28 @@ class DataFile(object):
             return True, out
 
 
+def _scanFile(filePath, manifest=None):
+    '''reads one file for DataDirectory._browseFiles, returns
+    (filePath, DataFile or None, error message or None).'''
+    try:
+        df = DataFile(filePath, manifest)
+    except Exception, e:
+        return filePath, None, '%s: %s' % (type(e).__name__, e)
+    return filePath, df, df.readError
+
+
 class DataDirectory(object):
     '''A DataDirectory object contains information about a folder
     of GIS data, and has methods for loading that data, as well as
     methods for configuring how that data will be loaded.'''
-    def __init__(self, folderOrFileList ):
-        # read folder or file list
-        self._browseFiles( folderOrFileList )
+    def __init__(self, folderOrFileList, workers=1, manifest=None ):
+        # read folder or file list, scanning files on `workers` threads
+        # and reusing the results in the scan manifest, if one is given
+        # (see openManifest)
+        self.manifest = openManifest(manifest)
+        self._browseFiles( folderOrFileList, workers )
+        if self.manifest is not None:
+            self.manifest.save()
         # these shouild be configured
         self.targetDataSource = None
         self.destinationEPSG = None
@@ -278,14 +478,18 @@ class DataDirectory(object):
         else:
             return []
 
-    def _browseFiles(self, folderOrFileList ):
+    def _browseFiles(self, folderOrFileList, workers=1 ):
         '''called when DataDirectories are created, this method searches the
-        designated folder for GIS data files and gathers their information.'''
+        designated folder for GIS data files and gathers their information.
+        Files are read on a pool of `workers` threads, and the results are
+        merged in the order of the file list, so the outcome doesn't depend
+        on the number of workers. Files that can't be read are left out of
+        self.files, and listed with their errors in self.scanErrors.'''
         # determine whether the incoming data is a list or string
         if type(folderOrFileList) == list:
             # it's a list
             shpFiles = folderOrFileList # done
-            self.folder = os.path.split(os.path.commonprefix(shpfiles))[0] # I LOVE stdlib!!!
+            self.folder = os.path.split(os.path.commonprefix(shpFiles))[0] # I LOVE stdlib!!!
         elif type(folderOrFileList) == str:
             # it's a folder
             self.folder = folderOrFileList
@@ -297,9 +501,23 @@ class DataDirectory(object):
         self.uniqueProjections = []
         self.files = []
         self.unprojectedFiles = []
+        self.scanErrors = []
+        # read the files, this needs ogrinfo to be in the PATH
+        scan = lambda fp: _scanFile(fp, self.manifest)
+        if workers > 1 and len(shpFiles) > 1:
+            pool = ThreadPool(workers)
+            try:
+                dataFiles = pool.map(scan, shpFiles)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            dataFiles = [scan(fp) for fp in shpFiles]
         # set fileList
-        for fp in shpFiles:
-            df = DataFile( fp) # This line needs ogrinfo to be in the PATH
+        for fp, df, error in dataFiles:
+            if error:
+                self.scanErrors.append((fp, error))
+                continue
             self.files.append( df ) # add the datafile object
             if df.hasProj: # this file has a proj file
                 if df.baseWkt not in self._wkts(): # new proj
@@ -311,6 +529,11 @@ class DataDirectory(object):
                     df.proj = p # tell the file which projection it has
             else: # has no proj file
                 self.unprojectedFiles.append(df)
+        if self.scanErrors:
+            print '%s of %s files could not be read:' % (len(self.scanErrors),
+                    len(shpFiles))
+            for fp, error in self.scanErrors:
+                print '    %s: %s' % (fp, error.strip())
 
     def makeXlsConfig(self, filePath=None):
         if not HAS_XLWT:
@@ -442,9 +665,12 @@ EPSG codes for input can be found using these websites:
         else:
             print s
 
-def parseXlsFile(xls_file):
+def parseXlsFile(xls_file, manifest=None):
     '''Parses an xls file into Projection and DataFile objects.
-    Returns list of Projection objects, and list of DataFile objects.'''
+    Returns list of Projection objects, and list of DataFile objects.
+    With a scan manifest (see openManifest, there is none by default),
+    files are only read again if they have changed since they were
+    recorded in it.'''
     if not HAS_XLRD:
         print '''
         The xlrd module is not installed or is not available on
@@ -480,9 +706,10 @@ def parseXlsFile(xls_file):
         proj.epsg = int(row[pcindex['epsg code']])
         projections.append(proj)
     # make the DataFiles
+    manifest = openManifest(manifest)
     files = []
     for row in frows:
-        f = DataFile(row[fcindex['file path']]) # this will cause it to read the file
+        f = DataFile(row[fcindex['file path']], manifest) # this may cause it to read the file
         f.destLayer = row[fcindex['layer name']]
         f.isTerrainLayer = bool(row[fcindex['is terrain']])
         f.isSiteLayer = bool(row[fcindex['is site layer']])
@@ -491,5 +718,7 @@ def parseXlsFile(xls_file):
         f.proj = projections[int(row[fcindex['projection']]) - 1]
         f.hasProj = True
         files.append(f)
+    if manifest is not None:
+        manifest.save()
     return projections, files
 
@@ -0,0 +1,197 @@
+"""
+A thread-safe pool of psycopg2 connections for PostSites.
+
+Opening a PostgreSQL connection is expensive, often more expensive than the
+queries PostSites runs on it. A ConnectionPool keeps a set of open
+connections around so that a DataSource can borrow one for each call and
+hand it back afterwards, and so that several threads can share one
+DataSource without sharing a connection.
+
+    >>> pool = ConnectionPool('dbname=mydb user=me password=pa55w0rd',
+    ...                       minSize=1, maxSize=8, idleTimeout=300)
+    >>> conn = pool.getConnection()
+    >>> # ... use conn ...
+    >>> pool.putConnection(conn)
+    >>> pool.closeAll()
+
+"""
+# Standard Library imports
+import threading
+import time
+
+# Third party imports
+import psycopg2 as pg
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+
+
+class PooledConnection(pg.extensions.connection):
+    """A psycopg2 connection that remembers when it was last handed back to
+    the pool and which server-side statements have been prepared on it."""
+    def __init__(self, *args, **kwargs):
+        super(PooledConnection, self).__init__(*args, **kwargs)
+        self.lastUsed = time.time()
+        self.prepared = set() # names of statements PREPAREd on this connection
+
+
+class ConnectionPool(object):
+    """
+    Holds between minSize and maxSize open connections to one database.
+    getConnection() hands out an idle connection (opening a new one if none
+    are idle and there is still room), and putConnection() returns it.
+    Connections are checked with checkQuery before being handed out, and idle
+    connections beyond minSize are closed once they have been idle for more
+    than idleTimeout seconds. If all maxSize connections are in use,
+    getConnection() waits up to waitTimeout seconds (forever if None) before
+    raising a PoolError.
+    """
+    def __init__(self, connString, minSize=1, maxSize=10, idleTimeout=300,
+                 checkQuery='SELECT 1', waitTimeout=None):
+        if maxSize < 1 or minSize > maxSize:
+            raise PoolError('pool sizes must satisfy 0 <= minSize <= maxSize, maxSize >= 1')
+        self.connString = connString
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.checkQuery = checkQuery
+        self.waitTimeout = waitTimeout
+        self.closed = False
+        self._idle = [] # idle connections, most recently used last
+        self._size = 0 # number of open connections, idle or in use
+        self._condition = threading.Condition(threading.Lock())
+        for i in range(minSize):
+            self._idle.append(self._newConnection())
+            self._size += 1
+
+    def __unicode__(self):
+        return 'ConnectionPool: %s of %s connections open, %s idle' % (
+                self._size, self.maxSize, len(self._idle))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def _newConnection(self):
+        return pg.connect(self.connString, connection_factory=PooledConnection)
+
+    def _isHealthy(self, conn):
+        '''runs the check query on a connection, and returns False if the
+        connection turns out to be unusable.'''
+        if conn.closed:
+            return False
+        if not self.checkQuery:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute(self.checkQuery)
+            cur.fetchall()
+            cur.close()
+            conn.rollback()
+            return True
+        except pg.Error:
+            return False
+
+    def _discard(self, conn):
+        '''closes a connection that will not go back into the pool. Must be
+        called while holding the lock.'''
+        self._size -= 1
+        try:
+            conn.close()
+        except pg.Error:
+            pass
+        self._condition.notify()
+
+    def _reapIdle(self):
+        '''closes connections that have been idle for longer than
+        idleTimeout, keeping at least minSize open. Must be called
+        while holding the lock.'''
+        if self.idleTimeout is None:
+            return
+        now = time.time()
+        # the least recently used connections are at the front
+        while (self._idle and self._size > self.minSize and
+               now - self._idle[0].lastUsed > self.idleTimeout):
+            self._discard(self._idle.pop(0))
+
+    def getConnection(self):
+        '''borrows a healthy connection from the pool.'''
+        deadline = None
+        if self.waitTimeout is not None:
+            deadline = time.time() + self.waitTimeout
+        self._condition.acquire()
+        try:
+            while True:
+                if self.closed:
+                    raise PoolError('connection pool is closed')
+                self._reapIdle()
+                if self._idle:
+                    conn = self._idle.pop()
+                    # check the connection without holding up other threads
+                    self._condition.release()
+                    try:
+                        healthy = self._isHealthy(conn)
+                    finally:
+                        self._condition.acquire()
+                    if healthy:
+                        return conn
+                    self._discard(conn)
+                    continue
+                if self._size < self.maxSize:
+                    self._size += 1
+                    self._condition.release()
+                    try:
+                        conn = self._newConnection()
+                    except:
+                        self._condition.acquire()
+                        self._size -= 1
+                        self._condition.notify()
+                        raise
+                    self._condition.acquire()
+                    return conn
+                # the pool is exhausted, wait for a connection to come back
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolError('no connection available after %s seconds' % self.waitTimeout)
+                    self._condition.wait(remaining)
+        finally:
+            self._condition.release()
+
+    def putConnection(self, conn, discard=False):
+        '''returns a borrowed connection to the pool. Any open transaction
+        is rolled back. Broken connections, or connections returned with
+        discard=True, are closed instead of being reused.'''
+        if not discard and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == pg.extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != pg.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except pg.Error:
+                    discard = True
+        self._condition.acquire()
+        try:
+            if discard or conn.closed or self.closed:
+                self._discard(conn)
+            else:
+                conn.lastUsed = time.time()
+                self._idle.append(conn)
+                self._reapIdle()
+                self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def closeAll(self):
+        '''closes every idle connection and stops handing out new ones.
+        Connections that are still in use are closed when they are returned.'''
+        self._condition.acquire()
+        try:
+            self.closed = True
+            while self._idle:
+                self._discard(self._idle.pop())
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
@@ -0,0 +1,280 @@
+"""
+Reads ESRI Shapefiles directly, without GDAL.
+
+The headers of the .shp, .shx and .dbf files of a shapefile are small and
+have fixed layouts, so the information that PostSites needs to configure a
+file (its layer name, shape type, number of features, bounding box and
+attribute fields) can be read straight from them instead of starting an
+ogrinfo process for every file.
+
+    >>> info = readInfo('/Users/benjamin/gis_data/parcels.shp')
+    >>> info['shpType'], info['featureCount']
+    ('Polygon', 53422)
+
+The layouts are described in the ESRI Shapefile Technical Description
+(July 1998) and the dBASE III file format.
+"""
+# Standard Library imports
+import datetime
+import os
+import struct
+
+# shape type codes, mapped to the shape type names that ogrinfo reports
+# (which are the keys of loader.shpTypeDict). Measured types have no
+# names of their own there, and are treated like their plain versions.
+SHAPE_TYPES = {
+        1:'Point',
+        3:'Line String',
+        5:'Polygon',
+        8:'Multi Point',
+        11:'3D Point',
+        13:'3D Line String',
+        15:'3D Polygon',
+        18:'3D Multi Point',
+        21:'Point',
+        23:'Line String',
+        25:'Polygon',
+        28:'Multi Point',
+        31:'3D Polygon', # MultiPatch
+        }
+
+SHP_FILE_CODE = 9994
+SHP_HEADER_LENGTH = 100
+SHX_RECORD_LENGTH = 8
+DBF_FIELD_LENGTH = 32
+DBF_FIELD_TERMINATOR = '\r'
+
+def readShpHeader(shpPath):
+    '''reads the 100 byte header of a .shp (or .shx) file. Returns a
+    dictionary with the shape type code, the file length in bytes, the
+    bounding box (xmin, ymin, xmax, ymax) and the z range (zmin, zmax).'''
+    f = open(shpPath, 'rb')
+    try:
+        header = f.read(SHP_HEADER_LENGTH)
+    finally:
+        f.close()
+    if len(header) < SHP_HEADER_LENGTH:
+        raise ValueError('%s is too short to be a shapefile' % shpPath)
+    fileCode, = struct.unpack('>i', header[0:4])
+    if fileCode != SHP_FILE_CODE:
+        raise ValueError('%s is not a shapefile' % shpPath)
+    # the file length is big endian and counted in 16 bit words
+    fileLength, = struct.unpack('>i', header[24:28])
+    version, shapeType = struct.unpack('<ii', header[28:36])
+    xmin, ymin, xmax, ymax, zmin, zmax = struct.unpack('<6d', header[36:84])
+    return {'shapeType':shapeType, 'fileLength':fileLength * 2,
+            'bbox':(xmin, ymin, xmax, ymax), 'zRange':(zmin, zmax)}
+
+def readShxCount(shxPath):
+    '''returns the number of records listed in a .shx index file.'''
+    header = readShpHeader(shxPath)
+    return (header['fileLength'] - SHP_HEADER_LENGTH) // SHX_RECORD_LENGTH
+
+def readDbfHeader(dbfPath):
+    '''reads the header of a .dbf file. Returns a dictionary with the
+    record count, the header and record lengths, and a list of fields
+    as (name, type, length, decimal count) tuples.'''
+    f = open(dbfPath, 'rb')
+    try:
+        header = f.read(32)
+        if len(header) < 32:
+            raise ValueError('%s is too short to be a dbf file' % dbfPath)
+        recordCount, headerLength, recordLength = struct.unpack('<IHH', header[4:12])
+        fields = []
+        while True:
+            descriptor = f.read(DBF_FIELD_LENGTH)
+            if not descriptor or descriptor[0] == DBF_FIELD_TERMINATOR:
+                break
+            if len(descriptor) < DBF_FIELD_LENGTH:
+                raise ValueError('%s has a truncated field list' % dbfPath)
+            name = descriptor[:11].split('\0')[0].strip()
+            fieldType = descriptor[11]
+            length, decimals = struct.unpack('<BB', descriptor[16:18])
+            fields.append((name, fieldType, length, decimals))
+    finally:
+        f.close()
+    return {'recordCount':recordCount, 'headerLength':headerLength,
+            'recordLength':recordLength, 'fields':fields}
+
+def readInfo(shpPath):
+    '''reads everything PostSites needs to know about a shapefile from its
+    .shp, .shx and .dbf headers. Returns a dictionary with defaultName (the
+    layer name ogrinfo would report), shpType (see SHAPE_TYPES),
+    featureCount, bbox and fields. Raises ValueError if the .shp header
+    can't be read or has a shape type that PostSites can't load.'''
+    base = os.path.splitext(shpPath)[0]
+    header = readShpHeader(shpPath)
+    if header['shapeType'] not in SHAPE_TYPES:
+        raise ValueError('%s has unsupported shape type %s' % (shpPath,
+            header['shapeType']))
+    info = {'defaultName':os.path.basename(base),
+            'shpType':SHAPE_TYPES[header['shapeType']],
+            'bbox':header['bbox'],
+            'featureCount':None,
+            'fields':None}
+    if os.path.exists(base + '.dbf'):
+        dbfHeader = readDbfHeader(base + '.dbf')
+        info['fields'] = dbfHeader['fields']
+        info['featureCount'] = dbfHeader['recordCount']
+    if os.path.exists(base + '.shx'):
+        info['featureCount'] = readShxCount(base + '.shx')
+    return info
+
+# shape type codes grouped by the kind of geometry they hold
+POINT_TYPES = (1, 11, 21)
+MULTIPOINT_TYPES = (8, 18, 28)
+POLYLINE_TYPES = (3, 13, 23)
+POLYGON_TYPES = (5, 15, 25)
+Z_TYPES = (11, 13, 15, 18, 31)
+
+class Shape(object):
+    '''One record of a .shp file. points is a list of (x, y) tuples, zs
+    is a matching list of z values (None for 2D shape types) and parts
+    holds the index in points at which each part (ring or line) starts.'''
+    def __init__(self, shapeType, points, parts=None, zs=None):
+        self.shapeType = shapeType
+        self.points = points
+        self.parts = parts or [0]
+        self.zs = zs
+
+    def partPoints(self):
+        '''returns a list with the point indexes of each part.'''
+        ends = list(self.parts[1:]) + [len(self.points)]
+        return [range(start, end) for start, end in zip(self.parts, ends)]
+
+def _readShape(content):
+    shapeType, = struct.unpack('<i', content[:4])
+    if shapeType == 0: # a null shape
+        return None
+    zs = None
+    if shapeType in POINT_TYPES:
+        x, y = struct.unpack('<2d', content[4:20])
+        if shapeType in Z_TYPES:
+            zs = list(struct.unpack('<d', content[20:28]))
+        return Shape(shapeType, [(x, y)], zs=zs)
+    elif shapeType in MULTIPOINT_TYPES:
+        numPoints, = struct.unpack('<i', content[36:40])
+        parts = [0]
+        pointsStart = 40
+    elif shapeType in POLYLINE_TYPES + POLYGON_TYPES:
+        numParts, numPoints = struct.unpack('<2i', content[36:44])
+        parts = list(struct.unpack('<%si' % numParts, content[44:44 + 4 * numParts]))
+        pointsStart = 44 + 4 * numParts
+    else:
+        raise ValueError('unsupported shape type %s' % shapeType)
+    coordinates = struct.unpack('<%sd' % (2 * numPoints),
+            content[pointsStart:pointsStart + 16 * numPoints])
+    points = zip(coordinates[0::2], coordinates[1::2])
+    if shapeType in Z_TYPES:
+        # the z values follow the points and the z range
+        zStart = pointsStart + 16 * numPoints + 16
+        zs = list(struct.unpack('<%sd' % numPoints, content[zStart:zStart + 8 * numPoints]))
+    return Shape(shapeType, points, parts, zs)
+
+def iterShapes(shpPath):
+    '''generates a Shape (or None for null shapes) for every record of a
+    .shp file, in order.'''
+    f = open(shpPath, 'rb')
+    try:
+        f.seek(SHP_HEADER_LENGTH)
+        while True:
+            recordHeader = f.read(8)
+            if len(recordHeader) < 8:
+                break
+            recordNumber, contentLength = struct.unpack('>2i', recordHeader)
+            content = f.read(contentLength * 2)
+            yield _readShape(content)
+    finally:
+        f.close()
+
+def _dbfValue(raw, fieldType, decimals, encoding):
+    if fieldType in ('N', 'F'):
+        raw = raw.strip()
+        if not raw or raw.strip('*') == '':
+            return None
+        try:
+            if decimals > 0 or '.' in raw or 'e' in raw.lower():
+                return float(raw)
+            return int(raw)
+        except ValueError:
+            return None
+    elif fieldType == 'D':
+        raw = raw.strip()
+        try:
+            return datetime.date(int(raw[:4]), int(raw[4:6]), int(raw[6:8]))
+        except ValueError:
+            return None
+    elif fieldType == 'L':
+        if raw in 'YyTt':
+            return True
+        elif raw in 'NnFf':
+            return False
+        return None
+    else: # character and anything else
+        return raw.rstrip(' \0').decode(encoding, 'replace')
+
+def iterDbfRecords(dbfPath, encoding='latin-1'):
+    '''generates (deleted, values) for every record of a .dbf file, where
+    values is a list with one python value per field (see readDbfHeader),
+    and deleted is True for records that are marked as deleted.'''
+    header = readDbfHeader(dbfPath)
+    fields = header['fields']
+    offsets = []
+    offset = 1 # the first byte of each record is the deletion flag
+    for name, fieldType, length, decimals in fields:
+        offsets.append((offset, offset + length, fieldType, decimals))
+        offset += length
+    f = open(dbfPath, 'rb')
+    try:
+        f.seek(header['headerLength'])
+        for i in xrange(header['recordCount']):
+            record = f.read(header['recordLength'])
+            if len(record) < header['recordLength']:
+                break
+            values = [_dbfValue(record[start:end], fieldType, decimals, encoding)
+                    for start, end, fieldType, decimals in offsets]
+            yield record[0] == '*', values
+    finally:
+        f.close()
+
+def _signedArea(ring):
+    area = 0.0
+    for i in range(len(ring) - 1):
+        (x1, y1), (x2, y2) = ring[i], ring[i + 1]
+        area += x1 * y2 - x2 * y1
+    return area / 2.0
+
+def _contains(ring, point):
+    '''ray casting point in polygon test.'''
+    x, y = point
+    inside = False
+    for i in range(len(ring) - 1):
+        (x1, y1), (x2, y2) = ring[i], ring[i + 1]
+        if (y1 > y) != (y2 > y):
+            if x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+                inside = not inside
+    return inside
+
+def groupRings(shape):
+    '''groups the rings of a polygon Shape into polygons. Returns a list of
+    polygons, each a list of rings (outer ring first), each ring a list of
+    point indexes. Outer rings are clockwise in shapefiles and holes are
+    counterclockwise. Each hole goes to the outer ring that contains it.'''
+    outers = []
+    holes = []
+    for ring in shape.partPoints():
+        coords = [shape.points[i] for i in ring]
+        if _signedArea(coords) <= 0: # clockwise
+            outers.append((coords, [ring]))
+        else:
+            holes.append((coords, ring))
+    if not outers: # badly oriented, treat every ring as a polygon
+        return [[ring] for coords, ring in holes]
+    for coords, ring in holes:
+        owner = outers[-1]
+        for outer in outers:
+            if _contains(outer[0], coords[0]):
+                owner = outer
+                break
+        owner[1].append(ring)
+    return [rings for coords, rings in outers]
@@ -6,6 +6,25 @@ def colFormat(lay, columnList, leadingComma=True):
         pre = ' '
     return pre + ', '.join(['%s.%s' % (lay, col) for col in columnList])
 
+# Builds the condition that decides whether a geometry belongs to
+# a site. By default this is an exact ST_DWithin test. With
+# useBoundingBox, it is an index-only && test against the bounding
+# box of the site expanded by the radius, which is much cheaper for
+# complex polygons and gives a square area around the site. With
+# boundingBoxRecheck as well, the exact test is applied to the
+# geometries that pass the box test.
+# Other options are accepted and ignored, so that the options of
+# any query can be passed through.
+def withinSite(geom, siteGeom, siteRadius, useBoundingBox=False,
+               boundingBoxRecheck=False, **options):
+    exact = 'ST_DWithin(%s, %s, %s)' % (geom, siteGeom, siteRadius)
+    if not useBoundingBox:
+        return exact
+    box = '%s && ST_Expand(%s, %s)' % (geom, siteGeom, siteRadius)
+    if boundingBoxRecheck:
+        return '%s AND %s' % (box, exact)
+    return box
+
 # Creates a new layer in a PostGIS database
 # with an ogc_fid attribute
 # Variables:
@@ -47,6 +66,40 @@ def getInfo(layer, cols, sid):
 """ % {'layer':layer, 'columns':colFormat(layer, cols, False), 'sid':sid}
 
 
+# The subselect that getLayer and otherSites use to find the
+# geometry of the site in question.
+def _siteGeometry(siteLayer, id):
+    return """(SELECT
+            %(site_layer)s.wkb_geometry
+        FROM
+            %(site_layer)s
+        WHERE
+            %(site_layer)s.ogc_fid = %(site_id)s)""" % {'site_layer':siteLayer, 'site_id':id}
+
+# The GeoJSON (or the WKB) of a geometry, translated so that origin
+# (usually the centroid of a site) becomes 0, 0. The work is done by
+# PostGIS, so that less data is sent and encoded:
+# precision the number of decimal digits of each coordinate, None
+#   for the ST_AsGeoJSON default of 9. WKB always has every digit
+# simplify a tolerance to simplify the geometry with, keeping its
+#   topology (ST_SimplifyPreserveTopology), in the units of the layer
+# force2d drops the z of every vertex
+# geometryFormat 'geojson', or 'wkb' for little endian WKB bytea that
+#   is decoded in bulk, see wkb.decode
+# Other options are accepted and ignored, like withinSite does.
+def outputGeometry(geom, origin, precision=None, simplify=None, force2d=False,
+            geometryFormat='geojson', **options):
+    if simplify:
+        geom = 'ST_SimplifyPreserveTopology(%s, %s)' % (geom, float(simplify))
+    if force2d:
+        geom = 'ST_Force2D(%s)' % geom
+    geom = 'ST_Translate(%s,\n        -ST_X(%s), -ST_Y(%s))' % (geom, origin, origin)
+    if geometryFormat == 'wkb':
+        return "ST_AsBinary(%s, 'NDR')" % geom
+    if precision is not None:
+        return 'ST_AsGeoJSON(%s, %s)' % (geom, int(precision))
+    return 'ST_AsGeoJSON(%s)' % geom
+
 # Gets all the other objects from a layer
 # that are within the site_radius distance from
 # the site in question
@@ -56,36 +109,19 @@ def getInfo(layer, cols, sid):
 # %(columns)s the columns to return attribute data from
 # %(site_id)s the id of the site in question
 # %(site_radius)s the distance from the site to search
-def getLayer(siteLayer, layer, cols, id, siteRadius):
+# options, see withinSite and outputGeometry
+def getLayer(siteLayer, layer, cols, id, siteRadius, **options):
     return """SELECT
-	ST_AsGeoJSON(ST_Translate(%(layer)s.wkb_geometry,
-    -ST_X(ST_Centroid(
-        (SELECT
-            %(site_layer)s.wkb_geometry
-        FROM
-            %(site_layer)s
-        WHERE
-            %(site_layer)s.ogc_fid = %(site_id)s))),
-    -ST_Y(ST_Centroid(
-        (SELECT
-            %(site_layer)s.wkb_geometry
-        FROM
-            %(site_layer)s
-        WHERE
-            %(site_layer)s.ogc_fid = %(site_id)s)))
-    )) %(columns)s
+    %(geometry)s %(columns)s
     FROM
         %(layer)s
     WHERE
-        ST_DWithin(%(layer)s.wkb_geometry,
-        (SELECT
-            %(site_layer)s.wkb_geometry
-        FROM
-            %(site_layer)s
-        WHERE
-            %(site_layer)s.ogc_fid = %(site_id)s)
-        , %(site_radius)s)
-;""" % {'site_layer':siteLayer, 'layer':layer, 'columns':colFormat(layer, cols), 'site_id':id, 'site_radius':siteRadius}
+        %(within)s
+;""" % {'site_layer':siteLayer, 'layer':layer, 'columns':colFormat(layer, cols), 'site_id':id,
+        'geometry':outputGeometry('%s.wkb_geometry' % layer,
+            'ST_Centroid(%s)' % _siteGeometry(siteLayer, id), **options),
+        'within':withinSite('%s.wkb_geometry' % layer, _siteGeometry(siteLayer, id),
+            siteRadius, **options)}
 
 
 # Selects the site in question
@@ -94,31 +130,67 @@ def getLayer(siteLayer, layer, cols, id, siteRadius):
 # %(columns)s the columns to return attribute data from
 # %(site_id)s the id of the site in question
 # %(site_radius)s the distance from the site to search
-def getSite(siteLayer, cols, id, siteRadius):
+# options, see outputGeometry
+def getSite(siteLayer, cols, id, siteRadius, **options):
     return """SELECT
-	ST_AsGeoJSON(ST_Translate(%(site_layer)s.wkb_geometry,
-    -ST_X(ST_Centroid(
-        (SELECT
-            %(site_layer)s.wkb_geometry
-        FROM
-            %(site_layer)s
-        WHERE
-            %(site_layer)s.ogc_fid = %(site_id)s))),
-    -ST_Y(ST_Centroid(
-        (SELECT
-            %(site_layer)s.wkb_geometry
-        FROM
-            %(site_layer)s
-        WHERE
-            %(site_layer)s.ogc_fid = %(site_id)s)))
-    )) %(columns)s
+    %(geometry)s %(columns)s
+FROM
+    %(site_layer)s
+WHERE
+    %(site_layer)s.ogc_fid = %(site_id)s
+;""" % {'site_layer':siteLayer, 'columns':colFormat(siteLayer, cols), 'site_id':id, 'site_radius':siteRadius,
+        'geometry':outputGeometry('%s.wkb_geometry' % siteLayer,
+            'ST_Centroid(%s)' % _siteGeometry(siteLayer, id), **options)}
+
+# Gets the x and y of the centroid of the site in question, which
+# the geometries of the other queries are translated by.
+# Variables:
+# %(site_layer)s the layer used for sites
+# %(site_id)s the id of the site in question
+def getSiteOrigin(siteLayer, id):
+    return """SELECT
+    ST_X(ST_Centroid(%(site_layer)s.wkb_geometry)),
+    ST_Y(ST_Centroid(%(site_layer)s.wkb_geometry))
 FROM
     %(site_layer)s
 WHERE
     %(site_layer)s.ogc_fid = %(site_id)s
-;""" % {'site_layer':siteLayer, 'columns':colFormat(siteLayer, cols), 'site_id':id, 'site_radius':siteRadius}
+;""" % {'site_layer':siteLayer, 'site_id':id}
 
 
+# The nearest feature of a layer to a point, as a subquery for a
+# LATERAL join. ORDER BY <-> with LIMIT 1 walks the spatial index of
+# the layer outwards from the point and stops at the first feature,
+# instead of computing and sorting the distance to every feature
+# within the search distance. For geometries, <-> is the exact
+# distance from PostGIS 2.2 (with PostgreSQL 9.5) on.
+# Variables:
+# layer the layer to search
+# columns what to select from it
+# point the point to search from, usually from the outer query
+# maxDistance the distance to search within, None for no limit
+def _nearestFeature(layer, columns, point, maxDistance=None):
+    within = ''
+    if maxDistance is not None:
+        within = """
+        WHERE
+            ST_DWithin(%s.wkb_geometry, %s, %s)""" % (layer, point, maxDistance)
+    return """SELECT
+            %(columns)s
+        FROM
+            %(layer)s%(within)s
+        ORDER BY
+            %(layer)s.wkb_geometry <-> %(point)s
+        LIMIT 1""" % {'layer':layer, 'columns':columns, 'point':point,
+        'within':within}
+
+# The z of a terrain point: from its geometry, or else from zColumn.
+def _terrainZ(terrainLayer, zColumn=None):
+    if zColumn:
+        return 'COALESCE(ST_Z(%(t)s.wkb_geometry), %(t)s.%(z)s::float8)' % {
+            't':terrainLayer, 'z':zColumn}
+    return 'ST_Z(%s.wkb_geometry)' % terrainLayer
+
 # Finds the closest z value in the terrain layer
 # to some geometry and returns that z value.
 # uses radius to search within.
@@ -127,24 +199,125 @@ WHERE
 # %(terrain_layer)s the layer to get a z value from
 # %(max_distance)s the maximum distance to search within for a z value (smaller=faster)
 # %(id)s the object id (in from_layer) to get a z value for
-def nearestZ(forLayer, terrainLayer, searchDistance, id):
-    return """SELECT ST_Z(t.wkb_geometry)
-FROM %(terrain_layer)s As t, %(from_layer)s As f
-WHERE ST_DWithin( t.wkb_geometry, (ST_Centroid(f.wkb_geometry)) , %(max_distance)s)
-AND f.ogc_fid = %(id)s
-ORDER BY ST_Distance(t.wkb_geometry, (ST_Centroid(f.wkb_geometry)))
-LIMIT 1;
-""" % {'from_layer':forLayer, 'terrain_layer':terrainLayer, 'max_distance':searchDistance, 'id':id}
+# zColumn the column of the terrain layer with z values for 2D points
+def nearestZ(forLayer, terrainLayer, searchDistance, id, zColumn=None):
+    return """SELECT postsites_nearest.z
+FROM %(from_layer)s AS postsites_feature
+CROSS JOIN LATERAL (
+        %(nearest)s
+    ) AS postsites_nearest
+WHERE postsites_feature.ogc_fid = %(id)s
+;""" % {'from_layer':forLayer, 'id':id,
+        'nearest':_nearestFeature(terrainLayer,
+            '%s AS z' % _terrainZ(terrainLayer, zColumn),
+            'ST_Centroid(postsites_feature.wkb_geometry)', searchDistance)}
 
+# Finds the feature of one layer that is closest to the centroid of
+# a feature of another layer, and returns its attribute data.
+# Variables:
+# %(layerToSearchFrom)s the layer of the feature to search from
+# %(layerToSearchWithin)s the layer to find the nearest feature in
+# %(max_distance)s the maximum distance to search within
+# %(id)s the object id (in layerToSearchFrom) to search from
+# %(columns)s the columns to return attribute data from
 def nearest(layerToSearchFrom, layerToSearchWithin, searchDistance, sid, cols):
-    return """SELECT %(columns)s
-FROM %(layerToSearchFrom)s , %(layerToSearchWithin)s
-WHERE ST_DWithin(%(layerToSearchWithin)s.wkb_geometry, (ST_Centroid(%(layerToSearchFrom)s.wkb_geometry)) , %(max_distance)s)
-AND %(layerToSearchFrom)s.ogc_fid = %(id)s
-ORDER BY ST_Distance(%(layerToSearchWithin)s.wkb_geometry, (ST_Centroid(%(layerToSearchFrom)s.wkb_geometry)))
-LIMIT 1;
-""" % { 'layerToSearchFrom':layerToSearchFrom, 'layerToSearchWithin':layerToSearchWithin,
-        'id':sid, 'columns':colFormat(layerToSearchWithin, cols, False), 'max_distance':searchDistance }
+    return """SELECT postsites_nearest.*
+FROM %(layerToSearchFrom)s AS postsites_feature
+CROSS JOIN LATERAL (
+        %(nearest)s
+    ) AS postsites_nearest
+WHERE postsites_feature.ogc_fid = %(id)s
+;""" % {'layerToSearchFrom':layerToSearchFrom, 'id':sid,
+        'nearest':_nearestFeature(layerToSearchWithin,
+            colFormat(layerToSearchWithin, cols, False),
+            'ST_Centroid(postsites_feature.wkb_geometry)', searchDistance)}
+
+# Finds the nearest feature of a layer to the centroid of every site
+# (or of the sites in site_ids) in one LATERAL join, returning rows of
+# (site_id, col, col, ...) in no particular order. Sites with nothing
+# within max_distance are left out.
+# Variables:
+# %(site_layer)s the layer used for sites
+# %(layer)s the layer to find the nearest feature in
+# %(columns)s the columns to return attribute data from
+# %(site_ids)s an array of site ids, or None for every site
+# %(max_distance)s the distance to search within, or None
+def nearestForSites(siteLayer, layer, cols, ids=None, searchDistance=None):
+    where = ''
+    if ids is not None:
+        where = '\nWHERE postsites_feature.ogc_fid = ANY(%s)' % ids
+    return """SELECT postsites_feature.ogc_fid AS site_id, postsites_nearest.*
+FROM %(site_layer)s AS postsites_feature
+CROSS JOIN LATERAL (
+        %(nearest)s
+    ) AS postsites_nearest%(where)s
+;""" % {'site_layer':siteLayer, 'where':where,
+        'nearest':_nearestFeature(layer, colFormat(layer, cols, False),
+            'ST_Centroid(postsites_feature.wkb_geometry)', searchDistance)}
+
+# Stores the rows of a query in a new table, replacing it if it
+# already exists.
+# Variables:
+# %(table)s the table to create
+# %(query)s the query to store the rows of
+def createResultsTable(table, sql):
+    return """DROP TABLE IF EXISTS %(table)s;
+CREATE TABLE %(table)s AS
+%(query)s;""" % {'table':table, 'query':_subquery(sql)}
+
+# Drapes a layer on the terrain: stores the z of the terrain point
+# nearest to the centroid of each of its features in z_column, in
+# one statement. Features with no terrain point within max_distance
+# keep their value.
+# Variables:
+# %(layer)s the layer to drape
+# %(z_column)s the column to store z values in, added if missing
+# %(terrain_layer)s the layer to get z values from
+# zColumn the column of the terrain layer with z values for 2D points
+# %(max_distance)s the distance to search within, None for no limit
+def drapeLayer(layer, zColumnOut, terrainLayer, zColumn=None, searchDistance=None):
+    return """ALTER TABLE %(layer)s ADD COLUMN IF NOT EXISTS %(z_column)s float8;
+UPDATE %(layer)s
+SET %(z_column)s = postsites_nearest.z
+FROM %(layer)s AS postsites_feature
+CROSS JOIN LATERAL (
+        %(nearest)s
+    ) AS postsites_nearest
+WHERE %(layer)s.ogc_fid = postsites_feature.ogc_fid
+;""" % {'layer':layer, 'z_column':zColumnOut,
+        'nearest':_nearestFeature(terrainLayer,
+            '%s AS z' % _terrainZ(terrainLayer, zColumn),
+            'ST_Centroid(postsites_feature.wkb_geometry)', searchDistance)}
+
+# Gets the z of the terrain point nearest to the centroid of each
+# feature of a layer that is within the site_radius distance from the
+# site in question, as rows of (ogc_fid, z).
+# Variables:
+# %(site_layer)s the layer used for sites
+# %(layer)s the layer to get z values for
+# %(terrain_layer)s the layer to get z values from
+# zColumn the column of the terrain layer with z values for 2D points
+# %(site_id)s the id of the site in question
+# %(site_radius)s the distance from the site to search
+# %(max_distance)s the distance to search for terrain within, or None
+# options, see withinSite
+def getLayerZ(siteLayer, layer, terrainLayer, zColumn, id, siteRadius,
+              searchDistance=None, **options):
+    return """SELECT
+    %(layer)s.ogc_fid, postsites_nearest.z
+FROM
+    %(layer)s
+    CROSS JOIN LATERAL (
+        %(nearest)s
+    ) AS postsites_nearest
+WHERE
+    %(within)s
+;""" % {'layer':layer,
+        'nearest':_nearestFeature(terrainLayer,
+            '%s AS z' % _terrainZ(terrainLayer, zColumn),
+            'ST_Centroid(%s.wkb_geometry)' % layer, searchDistance),
+        'within':withinSite('%s.wkb_geometry' % layer,
+            _siteGeometry(siteLayer, id), siteRadius, **options)}
 
 # Gets all the other objects from the site layer
 # that are within the site_radius distance from
@@ -154,37 +327,722 @@ LIMIT 1;
 # %(columns)s the columns to return attribute data from
 # %(site_id)s the id of the site in question
 # %(site_radius)s the distance from the site to search
-def otherSites(siteLayer, cols, id, siteRadius):
+# options, see withinSite and outputGeometry
+def otherSites(siteLayer, cols, id, siteRadius, **options):
     return """SELECT
-	ST_AsGeoJSON(ST_Translate(%(site_layer)s.wkb_geometry,
-    -ST_X(ST_Centroid(
-        (SELECT
-            %(site_layer)s.wkb_geometry
-        FROM
-            %(site_layer)s
-        WHERE
-            %(site_layer)s.ogc_fid = %(site_id)s))),
-    -ST_Y(ST_Centroid(
-        (SELECT
-            %(site_layer)s.wkb_geometry
-        FROM
-            %(site_layer)s
-        WHERE
-            %(site_layer)s.ogc_fid = %(site_id)s)))
-    )) %(columns)s
+    %(geometry)s %(columns)s
     FROM
         %(site_layer)s
     WHERE
-        ST_DWithin(%(site_layer)s.wkb_geometry,
-        (SELECT
-            %(site_layer)s.wkb_geometry
-        FROM
-            %(site_layer)s
-        WHERE
-            %(site_layer)s.ogc_fid = %(site_id)s)
-        , %(site_radius)s)
+        %(within)s
     AND
         %(site_layer)s.ogc_fid != %(site_id)s
-;""" % {'site_layer':siteLayer, 'columns':colFormat(siteLayer, cols), 'site_id':id, 'site_radius':siteRadius}
+;""" % {'site_layer':siteLayer, 'columns':colFormat(siteLayer, cols), 'site_id':id,
+        'geometry':outputGeometry('%s.wkb_geometry' % siteLayer,
+            'ST_Centroid(%s)' % _siteGeometry(siteLayer, id), **options),
+        'within':withinSite('%s.wkb_geometry' % siteLayer, _siteGeometry(siteLayer, id),
+            siteRadius, **options)}
+
+
+
+# layer_index values used by getSiteLayers for the site layer itself
+SITE_INDEX = -1
+OTHERSITES_INDEX = -2
+
+# Gets the site, the other nearby sites and every other layer
+# within the site_radius distance from the site in one statement.
+# The site geometry and its centroid are looked up once in a CTE,
+# and each layer is a branch of a UNION ALL. Every row holds the
+# layer_index of the layer it came from (an index into the layers
+# list, or SITE_INDEX / OTHERSITES_INDEX), the geometry translated
+# to the site centroid (see outputGeometry) and a json array of the
+# layer's attribute columns, so that layers with different columns
+# can share one result set.
+# Variables:
+# siteLayer the layer used for sites
+# siteCols the columns to return for the site layer
+# layers a list of (layer, cols, geometry) tuples for the other
+#   layers, where geometry is a dictionary of outputGeometry options
+# options, see withinSite, and outputGeometry for the site layer
+# id the id of the site in question
+# siteRadius the distance from the site to search
+# nearbySites whether to include the other nearby sites
+# terrainIndex the index of the terrain layer in layers, if any. Its
+#   branch returns one row with a NULL geometry and a json array
+#   of the terrain arrays (see _terrainQuery) instead.
+# terrainZColumn the z column of the terrain layer
+def getSiteLayers(siteLayer, siteCols, layers, id, siteRadius, nearbySites=True,
+                  terrainIndex=None, terrainZColumn=None, **options):
+    branch = """SELECT
+    %(layer_index)s AS layer_index,
+    %(geometry)s,
+    %(columns)s
+FROM
+    postsites_site, %(layer)s
+WHERE
+    %(condition)s"""
+    def within(layer):
+        return withinSite('%s.wkb_geometry' % layer, 'postsites_site.geom',
+                siteRadius, **options)
+    def geometry(layer, geometryOptions):
+        return outputGeometry('%s.wkb_geometry' % layer, 'postsites_site.origin',
+                **dict(options, **geometryOptions))
+    branches = []
+    branches.append(branch % {'layer_index':SITE_INDEX, 'layer':siteLayer,
+        'geometry':geometry(siteLayer, options),
+        'columns':_jsonArray(siteLayer, siteCols),
+        'condition':'%s.ogc_fid = %s' % (siteLayer, id)})
+    if nearbySites:
+        branches.append(branch % {'layer_index':OTHERSITES_INDEX, 'layer':siteLayer,
+            'geometry':geometry(siteLayer, options),
+            'columns':_jsonArray(siteLayer, siteCols),
+            'condition':within(siteLayer) +
+                ' AND %s.ogc_fid != %s' % (siteLayer, id)})
+    for i in range(len(layers)):
+        layer, cols, geometryOptions = layers[i]
+        if i == terrainIndex:
+            arrays = ['x', 'y', 'z'] + ['postsites_c%s' % n for n in range(len(cols or []))]
+            if options.get('terrainEngine') == 'postgis':
+                arrays.insert(3, 'faces')
+            branches.append("""SELECT
+    %(layer_index)s AS layer_index,
+    NULL::%(geometry_type)s,
+    %(arrays)s
+FROM (
+WITH %(terrain)s
+) AS postsites_mesh""" % {'layer_index':i,
+                'geometry_type':options.get('geometryFormat') == 'wkb' and 'bytea' or 'text',
+                'arrays':_jsonArray('postsites_mesh', arrays),
+                'terrain':_terrainQuery(layer, cols, terrainZColumn,
+                    'postsites_site', siteRadius, **options)})
+            continue
+        branches.append(branch % {'layer_index':i, 'layer':layer,
+            'geometry':geometry(layer, geometryOptions),
+            'columns':_jsonArray(layer, cols),
+            'condition':within(layer)})
+    return """WITH postsites_site AS (
+    SELECT
+        %(site_layer)s.wkb_geometry AS geom,
+        ST_Centroid(%(site_layer)s.wkb_geometry) AS origin
+    FROM
+        %(site_layer)s
+    WHERE
+        %(site_layer)s.ogc_fid = %(site_id)s
+)
+%(branches)s
+;""" % {'site_layer':siteLayer, 'site_id':id,
+        'branches':'\nUNION ALL\n'.join(branches)}
+
+# Builds a json array of columns of lay. An ARRAY constructor is not
+# a function call, so unlike json_build_array it is not limited to
+# 100 arguments, and wide layers still fit.
+def _jsonArray(lay, columnList):
+    return 'array_to_json(ARRAY[%s]::json[])' % ', '.join(['to_json(%s.%s)' % (
+        lay, col) for col in columnList or []])
+
+# The terrain is triangulated rather than drawn feature by feature,
+# so its queries return plain numbers instead of GeoJSON: the x and
+# y of every terrain point within the site_radius distance from the
+# site (translated to the site centroid), its z (from the geometry,
+# or else from zColumn, or else 0) and its attribute columns.
+# Variables:
+# layer the terrain layer
+# cols the columns to return attribute data from
+# zColumn the column that holds z values for 2D points, or None
+# sites the CTE with the geom and origin of the site(s)
+# siteRadius the distance from the site to search
+# siteColumn a column to select in front of the points, or None
+# terrainDecimation thins the points out, see _decimateTerrain
+def _terrainPoints(layer, cols, zColumn, sites, siteRadius, siteColumn=None,
+                   terrainDecimation=None, **options):
+    z = 'ST_Z(%s.wkb_geometry)' % layer
+    if zColumn:
+        z = '%s, %s.%s::float8' % (z, layer, zColumn)
+    columns = ''.join([',\n        %s.%s AS postsites_c%s' % (layer, col, i)
+        for i, col in enumerate(cols or [])])
+    names = ['x', 'y', 'z'] + ['postsites_c%s' % i for i in range(len(cols or []))]
+    if siteColumn:
+        names.insert(0, 'site_id')
+        siteColumn = '%s,\n        ' % siteColumn
+    points = """SELECT
+        %(site_column)sST_X(%(layer)s.wkb_geometry) - ST_X(%(sites)s.origin) AS x,
+        ST_Y(%(layer)s.wkb_geometry) - ST_Y(%(sites)s.origin) AS y,
+        COALESCE(%(z)s, 0) AS z%(columns)s
+    FROM
+        %(sites)s, %(layer)s
+    WHERE
+        %(within)s""" % {'site_column':siteColumn or '', 'layer':layer, 'sites':sites,
+        'z':z, 'columns':columns,
+        'within':withinSite('%s.wkb_geometry' % layer, '%s.geom' % sites,
+            siteRadius, **options)}
+    if terrainDecimation:
+        return _decimateTerrain(points, names, terrainDecimation)
+    return points
+
+# Thins out the terrain points selected by points before they are
+# triangulated, keeping the columns in names. terrainDecimation is a
+# dictionary that can hold:
+# gridSize keep one point (the one nearest the middle) in each grid
+#   cell of this size
+# rings a list of (distance, gridSize) tuples, ordered by distance,
+#   used instead of gridSize for points up to that distance from
+#   the site centroid (a distance of None is everything further
+#   out, any rings after it are ignored). A gridSize of 0 keeps
+#   every point of that ring. Points beyond the last ring use its
+#   gridSize.
+# maxError also keep the points of a cell whose z is further than
+#   this from the average z of the cell
+# maxVertices keep at most this many points per site, preferring one
+#   point in each cell of a grid sized to the budget, and points
+#   near the site centroid
+def _decimateTerrain(points, names, terrainDecimation):
+    options = terrainDecimation
+    site = ''
+    if 'site_id' in names:
+        site = 'postsites_d.site_id, '
+    selected = ', '.join(['postsites_d.%s' % name for name in names])
+    distance = 'postsites_d.x * postsites_d.x + postsites_d.y * postsites_d.y'
+    cell = None
+    if options.get('rings'):
+        cases = []
+        for ringDistance, ringSize in options['rings']:
+            outerSize = float(ringSize or 0)
+            if ringDistance is None:
+                break # rings after this one are never reached
+            cases.append('WHEN %s <= %s THEN %s' % (distance,
+                float(ringDistance) ** 2, outerSize))
+        if cases:
+            cell = 'CASE %s ELSE %s END' % (' '.join(cases), outerSize)
+        else:
+            cell = '%s' % outerSize
+    elif options.get('gridSize'):
+        cell = '%s' % float(options['gridSize'])
+    if cell:
+        keep = 'postsites_d.postsites_cell <= 0 OR postsites_d.postsites_cell_rank = 1'
+        if options.get('maxError') is not None:
+            keep += ' OR abs(postsites_d.z - postsites_d.postsites_cell_z) > %s' % float(
+                    options['maxError'])
+        points = _gridThin(points, selected, site, cell, keep)
+    if options.get('maxVertices'):
+        budget = int(options['maxVertices'])
+        cell = """GREATEST(sqrt((max(postsites_d.x) OVER postsites_w - min(postsites_d.x) OVER postsites_w) *
+                (max(postsites_d.y) OVER postsites_w - min(postsites_d.y) OVER postsites_w) / %s), 1e-9)""" % budget
+        ranked = _gridThin(points, selected + ', postsites_d.postsites_cell_rank', site,
+                cell, 'TRUE', 'WINDOW postsites_w AS (%s)' % (
+                    site and 'PARTITION BY postsites_d.site_id'))
+        points = """SELECT
+        %(selected)s
+    FROM (
+        SELECT
+            postsites_d.*,
+            row_number() OVER (%(partition)sORDER BY postsites_d.postsites_cell_rank,
+                %(distance)s) AS postsites_budget_rank
+        FROM (
+        %(ranked)s
+        ) AS postsites_d
+    ) AS postsites_d
+    WHERE
+        postsites_d.postsites_budget_rank <= %(budget)s""" % {'selected':selected,
+            'partition':site and 'PARTITION BY postsites_d.site_id ',
+            'distance':distance, 'ranked':ranked, 'budget':budget}
+    return points
+
+# Puts the points into grid cells of size cell (an expression that
+# can differ per point), numbers the points in each cell from the
+# one nearest the middle of the cell outwards, and keeps the points
+# for which keep is true.
+def _gridThin(points, selected, site, cell, keep, window=''):
+    cellKey = """%(site)spostsites_d.postsites_cell,
+                floor(postsites_d.x / NULLIF(postsites_d.postsites_cell, 0)),
+                floor(postsites_d.y / NULLIF(postsites_d.postsites_cell, 0))""" % {'site':site}
+    middle = """(postsites_d.x - (floor(postsites_d.x / NULLIF(postsites_d.postsites_cell, 0)) + 0.5) * postsites_d.postsites_cell) ^ 2 +
+                (postsites_d.y - (floor(postsites_d.y / NULLIF(postsites_d.postsites_cell, 0)) + 0.5) * postsites_d.postsites_cell) ^ 2"""
+    return """SELECT
+        %(selected)s
+    FROM (
+        SELECT
+            postsites_d.*,
+            row_number() OVER (PARTITION BY %(cell_key)s
+                ORDER BY %(middle)s) AS postsites_cell_rank,
+            avg(postsites_d.z) OVER (PARTITION BY %(cell_key)s) AS postsites_cell_z
+        FROM (
+            SELECT
+                postsites_d.*,
+                %(cell)s AS postsites_cell
+            FROM (
+            %(points)s
+            ) AS postsites_d
+            %(window)s
+        ) AS postsites_d
+    ) AS postsites_d
+    WHERE
+        %(keep)s""" % {'selected':selected, 'cell_key':cellKey, 'middle':middle,
+        'cell':cell, 'points':points, 'window':window, 'keep':keep}
+
+# The rest of a terrain query, after the CTE with the site(s): the
+# points (see _terrainPoints) aggregated into one array per column,
+# so that a whole terrain arrives as a single row of x, y and z
+# arrays (and one array per attribute column) that numpy can take
+# in bulk. With the 'postgis' terrainEngine, PostGIS triangulates
+# the points with ST_DelaunayTriangles as well. The triangle corners
+# are matched back to the points they came from, and the row gets
+# a flat array of the vertex indexes of every face after the z
+# array. Returns no row for a site without terrain points.
+# Variables:
+# bySite whether sites holds many sites, which adds the site id in
+#   front of each row, and one row per site
+# terrainEngine 'scipy' or 'postgis'
+def _terrainQuery(layer, cols, zColumn, sites, siteRadius, bySite=False,
+                  terrainEngine='scipy', **options):
+    siteColumn = None
+    if bySite:
+        siteColumn = '%s.site_id' % sites
+    columns = ['postsites_c%s' % i for i in range(len(cols or []))]
+    values = {'points':_terrainPoints(layer, cols, zColumn, sites, siteRadius,
+                siteColumn, **options),
+            'site':'', 'partition':'', 'same_site':'',
+            'grouping':'HAVING\n    count(*) > 0'}
+    if bySite:
+        values.update({'site':'postsites_vertices.site_id,\n    ',
+            'partition':'PARTITION BY postsites_points.site_id',
+            'grouping':'GROUP BY\n    postsites_vertices.site_id'})
+    if terrainEngine != 'postgis':
+        values['arrays'] = ',\n    '.join(['array_agg(postsites_vertices.%s) AS %s' % (col, col)
+            for col in ['x', 'y', 'z'] + columns])
+        return """postsites_vertices AS (
+    %(points)s
+)
+SELECT
+    %(site)s%(arrays)s
+FROM
+    postsites_vertices
+%(grouping)s""" % values
+    values.update({'site_id':'', 'tin_site':'', 'tin_select':'',
+        'same_site_id':'', 'tin_grouping':''})
+    if bySite:
+        values.update({'site_id':'postsites_triangles.site_id, ',
+            'tin_grouping':'\n        GROUP BY\n            postsites_vertices.site_id',
+            'tin_site':'postsites_tin.site_id,\n        ',
+            'tin_select':'postsites_vertices.site_id,\n            ',
+            'same_site_id':'postsites_vertices.site_id = postsites_triangles.site_id AND ',
+            'same_site':'\n        WHERE postsites_faces.site_id = postsites_vertices.site_id'})
+    values['arrays'] = ',\n    '.join(['array_agg(postsites_vertices.%s ORDER BY postsites_vertices.vertex) AS %s' % (col, col)
+        for col in ['x', 'y', 'z']] + ["""(SELECT array_agg(postsites_faces.vertex
+        ORDER BY postsites_faces.face, postsites_faces.corner)
+        FROM postsites_faces%(same_site)s) AS faces""" % values] +
+        ['array_agg(postsites_vertices.%s ORDER BY postsites_vertices.vertex) AS %s' % (col, col)
+        for col in columns])
+    return """postsites_points AS (
+    %(points)s
+), postsites_vertices AS (
+    SELECT
+        row_number() OVER (%(partition)s) - 1 AS vertex,
+        postsites_points.*
+    FROM
+        postsites_points
+), postsites_triangles AS (
+    SELECT
+        %(tin_site)s(postsites_tin.triangles).path[1] AS face,
+        (postsites_tin.triangles).geom AS triangle
+    FROM (
+        SELECT
+            %(tin_select)sST_Dump(ST_DelaunayTriangles(ST_Collect(
+                ST_MakePoint(postsites_vertices.x, postsites_vertices.y)), 0, 0)) AS triangles
+        FROM
+            postsites_vertices%(tin_grouping)s
+    ) AS postsites_tin
+), postsites_faces AS (
+    SELECT
+        %(site_id)spostsites_triangles.face,
+        postsites_corner.n AS corner,
+        min(postsites_vertices.vertex) AS vertex
+    FROM
+        postsites_triangles
+        CROSS JOIN generate_series(1, 3) AS postsites_corner(n)
+        JOIN postsites_vertices
+        ON %(same_site_id)spostsites_vertices.x = ST_X(ST_PointN(ST_ExteriorRing(
+            postsites_triangles.triangle), postsites_corner.n))
+        AND postsites_vertices.y = ST_Y(ST_PointN(ST_ExteriorRing(
+            postsites_triangles.triangle), postsites_corner.n))
+    GROUP BY
+        %(site_id)spostsites_triangles.face, postsites_corner.n
+)
+SELECT
+    %(site)s%(arrays)s
+FROM
+    postsites_vertices
+%(grouping)s""" % values
+
+# Gets the terrain of a site as one row of arrays (see above), or
+# no rows at all if there are no terrain points near the site.
+def getTerrain(siteLayer, layer, cols, zColumn, id, siteRadius, **options):
+    return """WITH postsites_site AS (
+    SELECT
+        %(site_layer)s.wkb_geometry AS geom,
+        ST_Centroid(%(site_layer)s.wkb_geometry) AS origin
+    FROM
+        %(site_layer)s
+    WHERE
+        %(site_layer)s.ogc_fid = %(site_id)s
+), %(terrain)s
+;""" % {'site_layer':siteLayer, 'site_id':id,
+        'terrain':_terrainQuery(layer, cols, zColumn, 'postsites_site',
+            siteRadius, **options)}
+
+# The queries below get data for many sites at once. Each one
+# resolves the geometry and centroid of every requested site in
+# a CTE, and returns the site id in front of each row so that the
+# rows can be split up by site afterwards. The geometry of each
+# row is translated to the centroid of the site it belongs to,
+# just like getLayer does for a single site.
+# Variables:
+# %(site_layer)s the layer used for sites
+# %(site_ids)s an array of site ids
+# %(site_radius)s the distance from each site to search
+def _sitesCTE(siteLayer, ids):
+    return """WITH postsites_sites AS (
+    SELECT
+        %(site_layer)s.ogc_fid AS site_id,
+        %(site_layer)s.wkb_geometry AS geom,
+        ST_Centroid(%(site_layer)s.wkb_geometry) AS origin
+    FROM
+        %(site_layer)s
+    WHERE
+        %(site_layer)s.ogc_fid = ANY(%(site_ids)s)
+)""" % {'site_layer':siteLayer, 'site_ids':ids}
+
+def getLayerForSites(siteLayer, layer, cols, ids, siteRadius, **options):
+    return """%(sites)s
+SELECT
+    postsites_sites.site_id,
+    %(geometry)s %(columns)s
+FROM
+    postsites_sites
+    JOIN %(layer)s
+    ON %(within)s
+;""" % {'sites':_sitesCTE(siteLayer, ids), 'layer':layer,
+        'columns':colFormat(layer, cols),
+        'geometry':outputGeometry('%s.wkb_geometry' % layer, 'postsites_sites.origin',
+            **options),
+        'within':withinSite('%s.wkb_geometry' % layer, 'postsites_sites.geom',
+            siteRadius, **options)}
+
+def getSites(siteLayer, cols, ids, siteRadius, **options):
+    return """%(sites)s
+SELECT
+    postsites_sites.site_id,
+    %(geometry)s %(columns)s
+FROM
+    postsites_sites
+    JOIN %(site_layer)s
+    ON %(site_layer)s.ogc_fid = postsites_sites.site_id
+;""" % {'sites':_sitesCTE(siteLayer, ids), 'site_layer':siteLayer,
+        'columns':colFormat(siteLayer, cols),
+        'geometry':outputGeometry('%s.wkb_geometry' % siteLayer, 'postsites_sites.origin',
+            **options)}
+
+def getSiteOrigins(siteLayer, ids):
+    return """%(sites)s
+SELECT
+    postsites_sites.site_id,
+    ST_X(postsites_sites.origin),
+    ST_Y(postsites_sites.origin)
+FROM
+    postsites_sites
+;""" % {'sites':_sitesCTE(siteLayer, ids)}
+
+def otherSitesForSites(siteLayer, cols, ids, siteRadius, **options):
+    return """%(sites)s
+SELECT
+    postsites_sites.site_id,
+    %(geometry)s %(columns)s
+FROM
+    postsites_sites
+    JOIN %(site_layer)s
+    ON %(within)s
+    AND %(site_layer)s.ogc_fid != postsites_sites.site_id
+;""" % {'sites':_sitesCTE(siteLayer, ids), 'site_layer':siteLayer,
+        'columns':colFormat(siteLayer, cols),
+        'geometry':outputGeometry('%s.wkb_geometry' % siteLayer, 'postsites_sites.origin',
+            **options),
+        'within':withinSite('%s.wkb_geometry' % siteLayer, 'postsites_sites.geom',
+            siteRadius, **options)}
+
+# The terrain of each site as one row of arrays, with the site id
+# in front. Sites without terrain points get no row.
+def getTerrainForSites(siteLayer, layer, cols, zColumn, ids, siteRadius, **options):
+    return """%(sites)s, %(terrain)s
+;""" % {'sites':_sitesCTE(siteLayer, ids),
+        'terrain':_terrainQuery(layer, cols, zColumn, 'postsites_sites',
+            siteRadius, bySite=True, **options)}
+
+def _subquery(sql):
+    '''strips the trailing semicolon so that a query can be nested.'''
+    return sql.strip().rstrip(';')
+
+# Wraps one of the queries above that return rows of
+# (ST_AsGeoJSON geometry, col, col, ...) so that PostGIS builds
+# the whole GeoJSON FeatureCollection for those rows. Returns one
+# row with the FeatureCollection as text (so psycopg2 leaves it
+# alone) and the number of features.
+# Variables:
+# %(query)s the query to aggregate
+# %(columns)s the columns to put into the properties of each feature
+def featureCollection(layerSQL, cols):
+    return """SELECT
+    json_build_object(
+        'type', 'FeatureCollection',
+        'features', COALESCE(json_agg(json_build_object(
+            'type', 'Feature',
+            'geometry', postsites_rows.st_asgeojson::json,
+            'properties', (SELECT row_to_json(postsites_props)
+                FROM (SELECT %(columns)s) AS postsites_props)
+        )), '[]'::json)
+    )::text,
+    count(*)
+FROM (
+%(query)s
+) AS postsites_rows
+;""" % {'query':_subquery(layerSQL),
+        'columns':colFormat('postsites_rows', cols, False)}
+
+# Combines several queries that return the same columns into
+# one statement, putting a tag in front of the rows of each.
+# Variables:
+# taggedSQLs a list of (integer tag, query) tuples
+def unionTagged(taggedSQLs):
+    branches = ["""SELECT %s AS tag, * FROM (
+%s
+) AS postsites_branch_%s""" % (tag, _subquery(sql), i)
+        for i, (tag, sql) in enumerate(taggedSQLs)]
+    return '\nUNION ALL\n'.join(branches) + '\n;'
+
+# The tables below hold precomputed site information made by
+# DataSource.buildSites. postsites_site_members lists, for each
+# site, the features of each layer that are within the site radius,
+# so that site queries become indexed equality lookups.
+SITE_CENTROIDS = 'postsites_site_centroids'
+SITE_MEMBERS = 'postsites_site_members'
+SITE_INFO = 'postsites_site_info'
+
+def createSiteTables():
+    return """CREATE TABLE IF NOT EXISTS %(info)s (
+    site_layer text NOT NULL,
+    site_radius float8 NOT NULL
+);
+ALTER TABLE %(info)s
+    ADD COLUMN IF NOT EXISTS use_bounding_box boolean,
+    ADD COLUMN IF NOT EXISTS bounding_box_recheck boolean;
+CREATE TABLE IF NOT EXISTS %(centroids)s (
+    site_id bigint PRIMARY KEY,
+    centroid geometry
+);
+CREATE TABLE IF NOT EXISTS %(members)s (
+    site_id bigint NOT NULL,
+    layer text NOT NULL,
+    fid bigint NOT NULL
+);
+CREATE INDEX IF NOT EXISTS %(members)s_site_layer_idx
+    ON %(members)s (site_id, layer);
+CREATE INDEX IF NOT EXISTS %(members)s_layer_idx
+    ON %(members)s (layer);
+""" % {'info':SITE_INFO, 'centroids':SITE_CENTROIDS, 'members':SITE_MEMBERS}
+
+# Records the site layer, radius and withinSite options that the
+# site tables were built with, and recomputes the centroid of every
+# site.
+def buildSiteCentroids(siteLayer, siteRadius, useBoundingBox=False,
+                       boundingBoxRecheck=False, **options):
+    return """DELETE FROM %(info)s;
+INSERT INTO %(info)s (site_layer, site_radius, use_bounding_box, bounding_box_recheck)
+VALUES ('%(site_layer)s', %(site_radius)s, %(use_bounding_box)s, %(bounding_box_recheck)s);
+DELETE FROM %(centroids)s;
+INSERT INTO %(centroids)s (site_id, centroid)
+SELECT
+    %(site_layer)s.ogc_fid,
+    ST_Centroid(%(site_layer)s.wkb_geometry)
+FROM
+    %(site_layer)s
+;""" % {'info':SITE_INFO, 'centroids':SITE_CENTROIDS,
+        'site_layer':siteLayer, 'site_radius':siteRadius,
+        'use_bounding_box':bool(useBoundingBox) and 'TRUE' or 'FALSE',
+        'bounding_box_recheck':bool(boundingBoxRecheck) and 'TRUE' or 'FALSE'}
+
+# Replaces the site membership rows of one layer.
+# Variables:
+# %(site_layer)s the layer used for sites
+# %(layer)s the layer to find the features of each site in
+# %(site_radius)s the distance from each site to search
+def buildSiteMembers(siteLayer, layer, siteRadius, **options):
+    return """DELETE FROM %(members)s WHERE layer = '%(layer)s';
+INSERT INTO %(members)s (site_id, layer, fid)
+SELECT
+    postsites_s.ogc_fid,
+    '%(layer)s',
+    %(layer)s.ogc_fid
+FROM
+    %(site_layer)s AS postsites_s
+    JOIN %(layer)s
+    ON %(within)s
+;""" % {'members':SITE_MEMBERS, 'site_layer':siteLayer, 'layer':layer,
+        'within':withinSite('%s.wkb_geometry' % layer, 'postsites_s.wkb_geometry',
+            siteRadius, **options)}
+
+def siteInfoTableExists():
+    return """SELECT to_regclass('%(info)s') IS NOT NULL;""" % {
+            'info':SITE_INFO}
+
+# Gets the row of the site info table as json text, so that tables
+# made before a column was added can still be read.
+def getSiteInfo():
+    return """SELECT row_to_json(postsites_i)::text
+FROM %(info)s AS postsites_i
+;""" % {'info':SITE_INFO}
+
+# Gets the features of a layer for a site (or for an array of
+# sites if batch is True) from the site tables, translated to the
+# site centroid. For the site layer, otherSites chooses between the
+# site itself and the other nearby sites.
+# Variables:
+# %(layer)s the layer to retrieve data from
+# %(columns)s the columns to return attribute data from
+# %(site_id)s the id of the site in question, or an array of ids
+# options, see outputGeometry
+def getLayerPrebuilt(layer, cols, id, batch=False, otherSites=None, **options):
+    if batch:
+        siteColumn = '%s.site_id,' % SITE_MEMBERS
+        condition = '%s.site_id = ANY(%s)' % (SITE_MEMBERS, id)
+    else:
+        siteColumn = ''
+        condition = '%s.site_id = %s' % (SITE_MEMBERS, id)
+    if otherSites is True:
+        condition += ' AND %s.fid != %s.site_id' % (SITE_MEMBERS, SITE_MEMBERS)
+    elif otherSites is False:
+        condition += ' AND %s.fid = %s.site_id' % (SITE_MEMBERS, SITE_MEMBERS)
+    return """SELECT
+    %(site_column)s
+    %(geometry)s %(columns)s
+FROM
+    %(members)s
+    JOIN %(centroids)s ON %(centroids)s.site_id = %(members)s.site_id
+    JOIN %(layer)s ON %(layer)s.ogc_fid = %(members)s.fid
+WHERE
+    %(members)s.layer = '%(layer)s'
+    AND %(condition)s
+;""" % {'site_column':siteColumn, 'layer':layer, 'columns':colFormat(layer, cols),
+        'geometry':outputGeometry('%s.wkb_geometry' % layer, '%s.centroid' % SITE_CENTROIDS,
+            **options),
+        'members':SITE_MEMBERS, 'centroids':SITE_CENTROIDS,
+        'condition':condition}
+
+# Lists the indexes of a layer, with the first column that each
+# index covers and the index method (btree, gist, ...).
+# Variables:
+# %(layer)s the layer to list the indexes of
+def layerIndexes(layer):
+    return """SELECT
+    postsites_i.relname,
+    postsites_a.attname,
+    postsites_am.amname
+FROM
+    pg_index AS postsites_x
+    JOIN pg_class AS postsites_i ON postsites_i.oid = postsites_x.indexrelid
+    JOIN pg_am AS postsites_am ON postsites_am.oid = postsites_i.relam
+    JOIN pg_attribute AS postsites_a
+    ON postsites_a.attrelid = postsites_x.indrelid
+    AND postsites_a.attnum = postsites_x.indkey[0]
+WHERE
+    postsites_x.indrelid = '%(layer)s'::regclass
+;""" % {'layer':layer}
+
+# Gets the statistics bookkeeping of a layer: when it was last
+# analyzed (by hand or by autovacuum), and how many rows have
+# changed since then.
+def layerStatistics(layer):
+    return """SELECT
+    GREATEST(last_analyze, last_autoanalyze),
+    n_mod_since_analyze
+FROM
+    pg_stat_user_tables
+WHERE
+    relid = '%(layer)s'::regclass
+;""" % {'layer':layer}
+
+def createSpatialIndex(layer):
+    return """CREATE INDEX %(layer)s_wkb_geometry_geom_idx
+    ON %(layer)s USING GIST (wkb_geometry);""" % {'layer':layer}
+
+def createIdIndex(layer):
+    return """CREATE INDEX %(layer)s_ogc_fid_idx
+    ON %(layer)s (ogc_fid);""" % {'layer':layer}
+
+# Rewrites a layer in the order of one of its indexes, so that
+# features that are close together are stored close together.
+def clusterLayer(layer, index):
+    return """CLUSTER %(layer)s USING %(index)s;""" % {'layer':layer, 'index':index}
+
+def analyzeLayer(layer):
+    return """ANALYZE %(layer)s;""" % {'layer':layer}
+
+# Tables written by the COPY loader (see copyloader.py) look like the ones
+# ogr2ogr creates, with an ogc_fid key and a wkb_geometry column.
+def createLoadTable(table, columns, geometryType, epsg):
+    return """DROP TABLE IF EXISTS %(table)s CASCADE;
+CREATE TABLE %(table)s (
+    ogc_fid serial PRIMARY KEY,
+    wkb_geometry geometry(%(geometry_type)s, %(epsg)s)%(columns)s
+);""" % {'table':table, 'geometry_type':geometryType, 'epsg':epsg,
+        'columns':''.join([',\n    %s %s' % col for col in columns])}
+
+# a temporary table that rows are copied into before they are
+# transformed into the coordinate system of the layer table
+def createStagingTable(table, columns):
+    return """DROP TABLE IF EXISTS %(table)s;
+CREATE TEMPORARY TABLE %(table)s (
+    wkb_geometry geometry%(columns)s
+);""" % {'table':table,
+        'columns':''.join([',\n    %s %s' % col for col in columns])}
+
+def copyRows(table, columnNames):
+    return """COPY %(table)s (%(columns)s) FROM STDIN;""" % {'table':table,
+            'columns':', '.join(['wkb_geometry'] + columnNames)}
+
+def insertTransformed(table, stagingTable, columnNames, epsg):
+    cols = ''.join([', %s' % name for name in columnNames])
+    return """INSERT INTO %(table)s (wkb_geometry%(cols)s)
+SELECT ST_Transform(wkb_geometry, %(epsg)s)%(cols)s FROM %(staging)s;
+TRUNCATE %(staging)s;""" % {'table':table, 'staging':stagingTable,
+        'cols':cols, 'epsg':epsg}
+
+# Remembers which files each layer was last loaded from, and a
+# fingerprint of their contents, so that unchanged layers can be skipped.
+LOADED_FILES = 'postsites_loaded_files'
+
+def createLoadedFilesTable():
+    return """CREATE TABLE IF NOT EXISTS %(table)s (
+    layer text NOT NULL,
+    position integer NOT NULL,
+    file_path text NOT NULL,
+    fingerprint text NOT NULL,
+    loaded_at timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY (layer, position)
+);""" % {'table':LOADED_FILES}
+
+# only layers whose table still exists count as loaded
+def getLoadedFiles():
+    return """SELECT layer, file_path, fingerprint FROM %(table)s
+WHERE to_regclass(layer) IS NOT NULL
+ORDER BY layer, position;""" % {'table':LOADED_FILES}
+
+def loadedFilesTableExists():
+    return """SELECT to_regclass('%(table)s') IS NOT NULL;""" % {
+            'table':LOADED_FILES}
 
+def forgetLoadedFiles():
+    return """DELETE FROM %(table)s WHERE layer = %%(layer)s;""" % {
+            'table':LOADED_FILES}
 
+def recordLoadedFile():
+    return """INSERT INTO %(table)s (layer, position, file_path, fingerprint)
+VALUES (%%(layer)s, %%(position)s, %%(file_path)s, %%(fingerprint)s);""" % {
+            'table':LOADED_FILES}
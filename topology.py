@@ -0,0 +1,269 @@
+"""
+Encodes site documents as TopoJSON.
+
+Parcels and sites are wall-to-wall polygons, so a GeoJSON site document
+has every shared boundary in it twice, at full precision. A TopoJSON
+Topology has each boundary once, as an arc that the polygons on both
+sides refer to, and its arcs are quantized to integers and delta encoded
+so that most of their numbers are small.
+
+    >>> ds.config.topology = True
+    >>> ds.getSiteJson(203)
+    '{"type": "Topology", "transform": {...}, "objects": {"site": ...'
+
+makeTopology turns the LayerCollection dictionary of a site into a
+Topology. Each layer becomes a GeometryCollection in objects (in the
+order of the layers, and with the color of the layer), with the
+attributes of each feature as the properties of its geometry. The
+coordinates are already relative to the site centroid (see
+sqls.getLayer), and the transform maps the integer grid back to them.
+Only x and y are quantized: a third coordinate is kept as it is. The
+terrain Mesh has no TopoJSON equivalent, so it is left as it is.
+
+The topology is built the way the reference implementation builds it:
+a point is a junction if it is the end of a line, or if the lines and
+rings that pass through it don't all share the same neighbors there.
+Lines and rings are cut into arcs at their junctions, and arcs that are
+the same (in either direction) are stored only once.
+
+See https://github.com/topojson/topojson-specification
+"""
+# Standard Library imports
+from collections import OrderedDict
+
+DEFAULT_QUANTIZATION = 100000 # grid points across the site extent
+
+def _positions(geometry):
+    '''generates every position in a GeoJSON geometry dictionary.'''
+    if geometry is None:
+        return
+    geometryType = geometry['type']
+    if geometryType == 'GeometryCollection':
+        for member in geometry['geometries']:
+            for position in _positions(member):
+                yield position
+        return
+    coordinates = geometry['coordinates']
+    depth = {'Point':0, 'MultiPoint':1, 'LineString':1, 'MultiLineString':2,
+            'Polygon':2, 'MultiPolygon':3}[geometryType]
+    if depth == 0:
+        if coordinates:
+            yield coordinates
+        return
+    stack = [(coordinates, depth)]
+    while stack:
+        items, level = stack.pop()
+        if level == 1:
+            for position in items:
+                yield position
+        else:
+            stack.extend([(item, level - 1) for item in items])
+
+
+class _Topology(object):
+    """Collects the quantized lines and rings of every geometry, and cuts
+    them into shared arcs."""
+    def __init__(self, translate, scale):
+        self.translate = translate
+        self.scale = scale
+        self.lines = [] # lists of quantized points
+        self.rings = []
+
+    def quantize(self, position):
+        x0, y0 = self.translate
+        kx, ky = self.scale
+        point = (int(round((position[0] - x0) / kx)),
+                int(round((position[1] - y0) / ky)))
+        return point + tuple(position[2:])
+
+    def _points(self, positions):
+        points = []
+        for position in positions:
+            point = self.quantize(position)
+            if not points or point != points[-1]:
+                points.append(point)
+        return points
+
+    def addLine(self, positions):
+        '''remembers a line, returning a reference to it.'''
+        points = self._points(positions)
+        if len(points) == 1: # it collapsed onto one grid point
+            points.append(points[0])
+        self.lines.append(points)
+        return ('line', len(self.lines) - 1)
+
+    def addRing(self, positions):
+        '''remembers a ring, returning a reference to it.'''
+        points = self._points(positions)
+        if len(points) == 1 or points[0] != points[-1]:
+            points.append(points[0])
+        self.rings.append(points)
+        return ('ring', len(self.rings) - 1)
+
+    def _junctions(self):
+        neighbors = {}
+        junctions = set()
+        def visit(point, previous, following):
+            pair = frozenset([previous, following])
+            if point not in neighbors:
+                neighbors[point] = pair
+            elif neighbors[point] != pair:
+                junctions.add(point)
+        for line in self.lines:
+            junctions.add(line[0])
+            junctions.add(line[-1])
+            for i in range(1, len(line) - 1):
+                visit(line[i], line[i - 1], line[i + 1])
+        for ring in self.rings:
+            points = ring[:-1]
+            for i in range(len(points)):
+                visit(points[i], points[i - 1], points[(i + 1) % len(points)])
+        return junctions
+
+    def cut(self):
+        '''cuts every line and ring into arcs. Returns the arcs as lists
+        of points, and a dictionary mapping the reference of each line
+        and ring to its list of arc indexes, where ~i is arc i reversed.'''
+        junctions = self._junctions()
+        arcs = []
+        indexes = {}
+        def arcIndex(points):
+            key = tuple(points)
+            if key in indexes:
+                return indexes[key]
+            reversedKey = tuple(reversed(points))
+            if reversedKey in indexes:
+                return ~indexes[reversedKey]
+            arcs.append(points)
+            indexes[key] = len(arcs) - 1
+            return indexes[key]
+        def split(points):
+            refs = []
+            start = 0
+            for i in range(1, len(points)):
+                if points[i] in junctions or i == len(points) - 1:
+                    refs.append(arcIndex(points[start:i + 1]))
+                    start = i
+            return refs
+        pieces = {}
+        for i, line in enumerate(self.lines):
+            pieces[('line', i)] = split(line)
+        for i, ring in enumerate(self.rings):
+            points = ring[:-1]
+            starts = [n for n in range(len(points)) if points[n] in junctions]
+            if starts:
+                first = starts[0]
+            else:
+                # a ring that touches nothing is one closed arc, which
+                # starts at its smallest point so that the same ring
+                # found twice is the same arc
+                first = points.index(min(points))
+            points = points[first:] + points[:first]
+            pieces[('ring', i)] = split(points + points[:1])
+        return arcs, pieces
+
+
+def _isMesh(feature):
+    geometry = feature.get('geometry')
+    return geometry is not None and geometry['type'] == 'Mesh'
+
+def _encodeArc(points):
+    '''delta encodes the x and y of an arc.'''
+    encoded = [list(points[0])]
+    for previous, point in zip(points, points[1:]):
+        encoded.append([point[0] - previous[0], point[1] - previous[1]] +
+                list(point[2:]))
+    return encoded
+
+def _bounds(layers):
+    xs = []
+    ys = []
+    for layer in layers:
+        for feature in layer['contents']['features']:
+            if _isMesh(feature):
+                continue
+            for position in _positions(feature.get('geometry')):
+                xs.append(position[0])
+                ys.append(position[1])
+    if not xs:
+        return 0.0, 0.0, 0.0, 0.0
+    return min(xs), min(ys), max(xs), max(ys)
+
+def makeTopology(layerCollection, quantization=DEFAULT_QUANTIZATION):
+    """Encodes a LayerCollection dictionary (see DataSource._assembleSite)
+    as a TopoJSON Topology dictionary, on a grid of quantization points
+    across the extent of the site."""
+    layers = layerCollection['layers']
+    x0, y0, x1, y1 = _bounds(layers)
+    # json gives integral coordinates as ints, so divide as floats
+    scale = (float(x1 - x0) / (quantization - 1) or 1.0,
+            float(y1 - y0) / (quantization - 1) or 1.0)
+    topology = _Topology((x0, y0), scale)
+    def collect(geometry):
+        # replaces the coordinates of lines and rings with references
+        if geometry is None:
+            return None
+        geometryType = geometry['type']
+        coordinates = geometry.get('coordinates')
+        if geometryType == 'Point':
+            return coordinates and topology.quantize(coordinates)
+        elif geometryType == 'MultiPoint':
+            return [topology.quantize(position) for position in coordinates]
+        elif geometryType == 'LineString':
+            return topology.addLine(coordinates)
+        elif geometryType == 'MultiLineString':
+            return [topology.addLine(line) for line in coordinates]
+        elif geometryType == 'Polygon':
+            return [topology.addRing(ring) for ring in coordinates]
+        elif geometryType == 'MultiPolygon':
+            return [[topology.addRing(ring) for ring in polygon]
+                    for polygon in coordinates]
+        elif geometryType == 'GeometryCollection':
+            return [collect(member) for member in geometry['geometries']]
+    collected = []
+    for layer in layers:
+        collected.append([(feature, collect(feature.get('geometry')))
+            for feature in layer['contents']['features']
+            if not _isMesh(feature)])
+    arcs, pieces = topology.cut()
+    def encode(geometry, refs):
+        if geometry is None:
+            return {'type':None}
+        geometryType = geometry['type']
+        if geometryType in ('Point', 'MultiPoint'):
+            point = lambda p: list(p)
+            if geometryType == 'Point':
+                return {'type':'Point', 'coordinates':refs and point(refs) or []}
+            return {'type':'MultiPoint', 'coordinates':map(point, refs)}
+        elif geometryType in ('LineString', 'Polygon'):
+            if geometryType == 'LineString':
+                return {'type':geometryType, 'arcs':pieces[refs]}
+            return {'type':geometryType, 'arcs':[pieces[r] for r in refs]}
+        elif geometryType == 'MultiLineString':
+            return {'type':geometryType, 'arcs':[pieces[r] for r in refs]}
+        elif geometryType == 'MultiPolygon':
+            return {'type':geometryType, 'arcs':[[pieces[r] for r in polygon]
+                for polygon in refs]}
+        return {'type':'GeometryCollection', 'geometries':[encode(member, r)
+            for member, r in zip(geometry['geometries'], refs)]}
+    objects = OrderedDict()
+    for layer, features in zip(layers, collected):
+        geometries = []
+        for feature, refs in features:
+            encoded = encode(feature.get('geometry'), refs)
+            encoded['properties'] = feature.get('properties', {})
+            geometries.append(encoded)
+        # the terrain mesh goes in unchanged
+        geometries.extend([dict(feature['geometry'],
+            properties=feature.get('properties', {}))
+            for feature in layer['contents']['features']
+            if _isMesh(feature)])
+        collection = OrderedDict([('type', 'GeometryCollection'),
+            ('geometries', geometries)])
+        if layer.get('color'):
+            collection['color'] = layer['color']
+        objects[layer['name']] = collection
+    return OrderedDict([('type', 'Topology'),
+        ('transform', {'scale':list(scale), 'translate':[x0, y0]}),
+        ('objects', objects),
+        ('arcs', [_encodeArc(arc) for arc in arcs])])
@@ -0,0 +1,250 @@
+"""
+Decodes WKB geometries into coordinate arrays.
+
+With config.geometryFormat set to 'wkb', the site queries select each
+geometry with ST_AsBinary instead of ST_AsGeoJSON, so PostGIS never
+formats a coordinate as text and python never parses one. decode turns
+the WKB of a whole layer into the arrays that binarysite packs (see
+binarysite.featureArrays), and toGeoJSON turns those arrays into GeoJSON
+geometry dictionaries for the json output, so every output works from
+the same arrays.
+
+    >>> arrays = decode([row[0] for row in rows])
+    >>> arrays['coordinates'] # an (n, 3) array of x, y, z
+
+Only the structure of each geometry (its type and the length of each
+ring) is read with struct. The coordinates of the rings of the layer
+are joined into one buffer per kind of ring and read with one
+np.frombuffer each, without a python loop over the vertices. Without
+NumPy, each ring is unpacked with struct instead, and the arrays are
+lists.
+
+Both ISO WKB (as ST_AsBinary writes it) and EWKB are understood, in
+either byte order. M values are dropped, and 2D geometries get a z of 0
+(the dimensions array says which geometries have a real z).
+"""
+# Standard Library imports
+import struct
+
+# Third party imports
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+MULTIPOINT = 4
+MULTILINESTRING = 5
+MULTIPOLYGON = 6
+GEOMETRYCOLLECTION = 7
+
+EWKB_Z = 0x80000000
+EWKB_M = 0x40000000
+EWKB_SRID = 0x20000000
+
+GEOJSON_TYPES = {POINT:'Point', LINESTRING:'LineString', POLYGON:'Polygon',
+        MULTIPOINT:'MultiPoint', MULTILINESTRING:'MultiLineString',
+        MULTIPOLYGON:'MultiPolygon', GEOMETRYCOLLECTION:'GeometryCollection'}
+
+def _readHeader(blob, offset):
+    '''reads the byte order and type of the geometry at offset. Returns
+    (endian, geometry type, hasZ, number of dimensions, offset after the
+    header).'''
+    endian = ord(blob[offset]) == 1 and '<' or '>'
+    wkbType, = struct.unpack_from(endian + 'I', blob, offset + 1)
+    offset += 5
+    if wkbType & (EWKB_Z | EWKB_M | EWKB_SRID):
+        hasZ = bool(wkbType & EWKB_Z)
+        hasM = bool(wkbType & EWKB_M)
+        if wkbType & EWKB_SRID:
+            offset += 4
+        geometryType = wkbType & 0x0fffffff
+    else: # ISO WKB adds 1000 for z, 2000 for m and 3000 for both
+        geometryType = wkbType % 1000
+        hasZ = wkbType // 1000 in (1, 3)
+        hasM = wkbType // 1000 in (2, 3)
+    return endian, geometryType, hasZ, 2 + hasZ + hasM, offset
+
+
+class _Structure(object):
+    """The offset arrays of a layer, and where the coordinates of each of
+    its rings are in the joined WKB."""
+    def __init__(self):
+        self.geometryTypes = []
+        self.dimensions = []
+        self.featureOffsets = [0]
+        self.partTypes = []
+        self.partOffsets = [0]
+        self.rings = [] # (byte offset, vertex count, dimensions, hasZ, endian)
+
+    def addRing(self, blob, offset, count, dims, hasZ, endian):
+        self.rings.append((offset, count, dims, hasZ, endian))
+        return offset + 8 * dims * count
+
+    def readCount(self, blob, offset, endian):
+        count, = struct.unpack_from(endian + 'I', blob, offset)
+        return count, offset + 4
+
+    def readGeometry(self, blob, offset):
+        '''adds the parts of the geometry at offset, returning the offset
+        after it and (its type, hasZ).'''
+        endian, geometryType, hasZ, dims, offset = _readHeader(blob, offset)
+        if geometryType == POINT:
+            x, = struct.unpack_from(endian + 'd', blob, offset)
+            if x == x: # an empty point has NaN coordinates
+                self.addRing(blob, offset, 1, dims, hasZ, endian)
+                self.addPart(POINT)
+            offset += 8 * dims
+        elif geometryType == LINESTRING:
+            count, offset = self.readCount(blob, offset, endian)
+            offset = self.addRing(blob, offset, count, dims, hasZ, endian)
+            self.addPart(LINESTRING)
+        elif geometryType == POLYGON:
+            ringCount, offset = self.readCount(blob, offset, endian)
+            for i in range(ringCount):
+                count, offset = self.readCount(blob, offset, endian)
+                offset = self.addRing(blob, offset, count, dims, hasZ, endian)
+            self.addPart(POLYGON)
+        elif geometryType in (MULTIPOINT, MULTILINESTRING, MULTIPOLYGON,
+                GEOMETRYCOLLECTION):
+            memberCount, offset = self.readCount(blob, offset, endian)
+            for i in range(memberCount):
+                offset, (memberType, memberZ) = self.readGeometry(blob, offset)
+                hasZ = hasZ or memberZ
+        else:
+            raise ValueError('unsupported WKB geometry type %s' % geometryType)
+        return offset, (geometryType, hasZ)
+
+    def addPart(self, partType):
+        self.partTypes.append(partType)
+        self.partOffsets.append(len(self.rings))
+
+    def addFeature(self, blob, offset):
+        if offset is None:
+            self.geometryTypes.append(0)
+            self.dimensions.append(2)
+        else:
+            end, (geometryType, hasZ) = self.readGeometry(blob, offset)
+            self.geometryTypes.append(geometryType)
+            self.dimensions.append(hasZ and 3 or 2)
+        self.featureOffsets.append(len(self.partOffsets) - 1)
+
+
+def _gather(blob, rings, ringOffsets):
+    '''reads the coordinates of every ring into an (n, 3) array.'''
+    coordinates = np.zeros((ringOffsets[-1], 3), dtype=np.float64)
+    # the rings are read in groups that share a vertex layout: the bytes
+    # of each ring are one slice of the blob, so each group is joined
+    # and read with one frombuffer
+    groups = {}
+    for r, (start, count, dims, hasZ, endian) in enumerate(rings):
+        if count:
+            groups.setdefault((dims, hasZ, endian), []).append(r)
+    for (dims, hasZ, endian), group in groups.items():
+        values = np.frombuffer(''.join([blob[rings[r][0]:
+            rings[r][0] + 8 * dims * rings[r][1]] for r in group]),
+            dtype=endian + 'f8').reshape(-1, dims)
+        groupCounts = np.array([rings[r][1] for r in group], dtype=np.int64)
+        firstVertex = np.array([ringOffsets[r] for r in group], dtype=np.int64)
+        # where each vertex goes: the first vertex of its ring, plus its
+        # index within the ring
+        destination = np.arange(len(values)) + np.repeat(
+                firstVertex - (np.cumsum(groupCounts) - groupCounts), groupCounts)
+        coordinates[destination, 0:2] = values[:, 0:2]
+        if hasZ:
+            coordinates[destination, 2] = values[:, 2]
+    return coordinates
+
+def _unpack(blob, rings):
+    coordinates = []
+    for start, count, dims, hasZ, endian in rings:
+        values = struct.unpack_from('%s%sd' % (endian, count * dims), blob, start)
+        for i in range(0, count * dims, dims):
+            coordinates.append([values[i], values[i + 1],
+                hasZ and values[i + 2] or 0.0])
+    return coordinates
+
+def decode(geometries):
+    '''decodes a list of WKB geometries (str, buffer or None) into the
+    arrays of a binarysite 'features' layer: geometryTypes,
+    featureOffsets, partOffsets, ringOffsets and coordinates (an (n, 3)
+    array), plus dimensions (2 or 3 for each feature) and partTypes (the
+    type of each part: POINT, LINESTRING or POLYGON), which toGeoJSON
+    needs. The arrays are NumPy arrays, or lists without NumPy.'''
+    chunks = []
+    offsets = []
+    length = 0
+    for geometry in geometries:
+        if geometry is None:
+            offsets.append(None)
+            continue
+        if isinstance(geometry, memoryview):
+            geometry = geometry.tobytes()
+        else: # psycopg2 returns bytea as a buffer
+            geometry = str(geometry)
+        offsets.append(length)
+        chunks.append(geometry)
+        length += len(geometry)
+    blob = ''.join(chunks)
+    structure = _Structure()
+    for offset in offsets:
+        structure.addFeature(blob, offset)
+    ringOffsets = [0]
+    for start, count, dims, hasZ, endian in structure.rings:
+        ringOffsets.append(ringOffsets[-1] + count)
+    arrays = {'geometryTypes':structure.geometryTypes,
+            'dimensions':structure.dimensions,
+            'featureOffsets':structure.featureOffsets,
+            'partTypes':structure.partTypes,
+            'partOffsets':structure.partOffsets,
+            'ringOffsets':ringOffsets}
+    if not HAS_NUMPY:
+        arrays['coordinates'] = _unpack(blob, structure.rings)
+        return arrays
+    arrays = dict([(name, np.array(values, dtype=np.uint32))
+        for name, values in arrays.items()])
+    for name in ('geometryTypes', 'dimensions', 'partTypes'):
+        arrays[name] = arrays[name].astype(np.uint8)
+    arrays['coordinates'] = _gather(blob, structure.rings, ringOffsets)
+    return arrays
+
+def toGeoJSON(arrays):
+    '''builds a list of GeoJSON geometry dictionaries (or None) from the
+    arrays returned by decode.'''
+    def plain(values):
+        return hasattr(values, 'tolist') and values.tolist() or list(values)
+    geometryTypes, dimensions, featureOffsets, partTypes, partOffsets, \
+            ringOffsets, coordinates = [plain(arrays[name]) for name in (
+            'geometryTypes', 'dimensions', 'featureOffsets', 'partTypes',
+            'partOffsets', 'ringOffsets', 'coordinates')]
+    def ring(r, dims):
+        return [position[:dims] for position in
+                coordinates[ringOffsets[r]:ringOffsets[r + 1]]]
+    def part(p, dims):
+        rings = [ring(r, dims) for r in range(partOffsets[p], partOffsets[p + 1])]
+        if partTypes[p] == POINT:
+            return rings[0][0]
+        elif partTypes[p] == LINESTRING:
+            return rings[0]
+        return rings
+    geometries = []
+    for i, geometryType in enumerate(geometryTypes):
+        if geometryType == 0:
+            geometries.append(None)
+            continue
+        dims = dimensions[i]
+        parts = range(featureOffsets[i], featureOffsets[i + 1])
+        if geometryType == GEOMETRYCOLLECTION:
+            geometries.append({'type':'GeometryCollection', 'geometries':[
+                {'type':GEOJSON_TYPES[partTypes[p]], 'coordinates':part(p, dims)}
+                for p in parts]})
+            continue
+        members = [part(p, dims) for p in parts]
+        if geometryType in (POINT, LINESTRING, POLYGON):
+            members = members and members[0] or []
+        geometries.append({'type':GEOJSON_TYPES[geometryType],
+            'coordinates':members})
+    return geometries